@@ -1,10 +1,18 @@
 """
 business-logic for libfs
 
-The database contains 3 tables:
-"views", "files" and "defaults".
+The database contains 4 tables:
+"views", "files", "trees" and "defaults".
 "views" defines how the vitrual directory structure is created
 "files" stores the actual information.
+It has a column for each key used by the dirtree or the filename_generator
+of any view. All other metadata of a file are stored sparsely in
+the json-column "extra". Libraries created before had a column for
+every valid key, they are converted by migrate_files_table.
+"trees" holds for every view and file the virtual directory and
+the generated filename with its duplicate counter. It is kept up to
+date whenever "files" changes, so that listing a directory is a single
+indexed query.
 
 views has three columns:
 view_name, directory_structure, filename_generator
@@ -14,7 +22,8 @@ view_name, directory_structure, filename_generator
 are used to create the directory-structure.
 - filename_generator is string, where %{key} is replaced by the corresponding
 metadata, e.g. %{src_filename} just passes the original filename
-whereas %{title} uses the title field.
+whereas %{title} uses the title field. "%%" gives a literal "%",
+so "%%{" gives a literal "%{".
 """
 
 import errno
@@ -23,34 +32,78 @@ import os
 import re
 
 from importlib import import_module
+from urllib.parse import parse_qsl
 
 from Libfs.misc import calltrace_logger, get_vpath_list
+from Libfs.snapshot import Snapshot
 import json
 import sys
 
 LOGGER = logging.getLogger(__name__)
 
+# number of values passed to a single statement,
+# below the maximum number of host parameters of sqlite
+MAX_HOST_PARAMETERS = 500
+
+def chunks(values, size=MAX_HOST_PARAMETERS):
+    """
+    return consecutive slices of the list values with at most size items
+    """
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
 class BusinessLogic:
     """
     Accessing the actual DB for the library.
     """
     FILES_TABLE = "files"
     VTREE_TABLE = "trees"
+    VTREE_INDEX = "trees_idx"
+    # the inodes are not unique, a file may have several hard links
+    SRC_INODE_INDEX = "src_inode_idx"
     VIEWS_TABLE = "views"
+    # directories completely written by an interrupted update
+    CHECKPOINTS_TABLE = "checkpoints"
+    # prefix of the indexes on the dirtree-columns of the views
+    DIRTREE_INDEX_PREFIX = "dirtree_idx"
+    # temporary table of the files found by a scan
+    SEEN_TABLE = "seen_files"
     MAGIX_TABLE = "defaults"
     MAGIX_FIELD = "json"
     MAGIC_KEYS = ["valid_keys", "default_view"]
     DEFAULT_VIEW_NAME = "default"
     SRC_FILENAME_KEY = "src_filename"
     SRC_INODE_KEY = "src_inode"
+    SRC_SIZE_KEY = "src_size"
+    SRC_MTIME_KEY = "src_mtime_ns"
+    # columns describing the source file itself, not its metadata
+    SRC_KEYS = [SRC_FILENAME_KEY, SRC_INODE_KEY, SRC_SIZE_KEY, SRC_MTIME_KEY]
+    # json-column with the metadata not used by any view
+    EXTRA_KEY = "extra"
     UNKNOWN = "Unknown"
+    # name of the n-th file with the same generated filename in a directory
+    DUPLICATE_NAME = "%s (libfs:%d)"
+    # number of rows written per transaction by add_entries
+    BATCH_SIZE = 1000
 
     @calltrace_logger
-    def __init__(self, db_connection, magix=None, current_view_name=None):
+    def __init__(self, db_connection, magix=None, current_view_name=None, db_profile="mount",
+                 snapshot=False, build_trees=True):
         """
         opens a sqlite file, does some checks,
         creates tables if required.
+        Tuning options for the database can be appended to the
+        db_connection like an URL-query, e.g. lib.db?journal_mode=WAL&cache_size=-65536.
+        They override the defaults of the db_profile ("mount" or "update").
+        With snapshot, the library is opened read-only and the current view
+        is loaded into memory once.
+        Without build_trees, the trees-table of an old library is not
+        created, e.g. because the files-table is converted first.
         """
+        db_options = {}
+        if "?" in db_connection:
+            db_connection, query = db_connection.split("?", 1)
+            db_options = dict(parse_qsl(query))
         try:
             db_type, user, password, host, database = \
                 re.match(r'(\S+)://(?:(.*?):(.*?))?(?:@(.*?)/)?(.*)', db_connection).groups()
@@ -72,10 +125,17 @@ class BusinessLogic:
             sys.exit(2)
 
         # check if we can open the database at all.
-        self.DB_BE.open(user, password, host, database)
+        self.read_only = snapshot
+        if snapshot:
+            db_profile = "snapshot"
+        self.DB_BE.open(user, password, host, database, db_options, db_profile,
+                        read_only=self.read_only)
 
         # check if the db contains all required tables
         if not self.check_db(): # do the table exist?
+            if self.read_only:
+                sys.stderr.write("Library %s does not exist.\n" % database)
+                sys.exit(1)
             do_setup_db = True
             # since we are creating the db, the default view must be DEFAULT_VIEW_NAME
             assert current_view_name in [self.DEFAULT_VIEW_NAME, None]
@@ -86,6 +146,8 @@ class BusinessLogic:
             self.magix = self.get_magix_from_db()
         else:
             self.magix = magix
+        # parsed filename generators by fn_gen
+        self.fn_formatters = {}
 
         if current_view_name is None:
             self.current_view_name = self.DEFAULT_VIEW_NAME
@@ -102,16 +164,34 @@ class BusinessLogic:
 
         self.metadata_plugin = import_module("Libfs.plugins.%s" % (self.magix["plugin"]))
 
-        self.ordered_files_keys = self.DB_BE.get_columns(self.FILES_TABLE)
+        self.read_files_keys()
+        self.upgrade_files_table()
 
         self.check_tables()
         LOGGER.debug("init: self.current_view = %s", self.current_view)
+        self.setup_queries()
+        if build_trees:
+            self.setup_trees_table()
 
         self.max_dir_level = len(self.current_view["dirtree"])
 
-        # in-memory cache for bookkeeping
-        self.vdirs = []
-        self.vtree = self.generate_vtree()
+        if snapshot:
+            self.snapshot = Snapshot(self)
+            self.src_by_inode = self.snapshot.src_by_inode
+            self.inode_by_src = self.snapshot.inode_by_src
+        else:
+            self.snapshot = None
+            # src_inode <-> src_filename of the files listed or looked up so far
+            self.src_by_inode = {}
+            self.inode_by_src = {}
+        self.data_version = self.DB_BE.get_data_version()
+
+        # in-memory cache for bookkeeping:
+        # canonical vpath <-> inode of the virtual directories,
+        # the root always has inode 1
+        self.vdir_inodes = {"": 1}
+        self.vdir_paths = {1: ""}
+        self.generate_vtree()
         # still in operations
         # pinode_fn2srcpath_map
 
@@ -212,15 +292,28 @@ class BusinessLogic:
         return
 
     @calltrace_logger
-    def get_vdir_inode(self, canon_path):
+    def get_vdir_inode(self, vpath):
         """
-        put vpath in a module-local cache
+        return the inode of a virtual directory,
+        allocate a new one on its first use
         """
-        if not canon_path in self.vdirs:
-            self.vdirs.append(canon_path)
-        vnode = self.vdirs.index(canon_path) + 1
+        canon_path = "/".join(get_vpath_list(vpath))
+        try:
+            return self.vdir_inodes[canon_path]
+        except KeyError:
+            pass
+        vnode = len(self.vdir_inodes) + 1
+        self.vdir_inodes[canon_path] = vnode
+        self.vdir_paths[vnode] = canon_path
         return vnode
 
+    def get_vdir_path(self, vnode):
+        """
+        return the canonical vpath of a virtual directory inode,
+        None if it is unknown
+        """
+        return self.vdir_paths.get(vnode)
+
     @calltrace_logger
     def walk_vtree(self, node):
         """
@@ -260,12 +353,474 @@ class BusinessLogic:
         self.DB_BE.execute_statment("insert into %s (name, json) values ('%s', '%s')" %
                                     (self.VIEWS_TABLE, self.DEFAULT_VIEW_NAME,
                                      json.dumps(self.current_view)))
-        self.DB_BE.execute_statment("create table %s (%s varchar unique, %s integer unique, %s)" %
-                                    (self.FILES_TABLE, self.SRC_FILENAME_KEY, self.SRC_INODE_KEY,
-                                     ",".join(self.magix["valid_keys"])))
+        self.create_files_table(self.FILES_TABLE, self.get_view_keys())
+        self.create_inode_index()
+        self.DB_BE.commit()
+        self.sync_view_indexes()
+        return
+
+    def create_files_table(self, table, keys):
+        """
+        create a files-table with columns for the given metadata keys
+        """
+        self.DB_BE.execute_statment("create table %s (%s varchar unique, %s integer, "\
+                                    "%s integer, %s integer, %s %s text)" %
+                                    (table, self.SRC_FILENAME_KEY, self.SRC_INODE_KEY,
+                                     self.SRC_SIZE_KEY, self.SRC_MTIME_KEY,
+                                     "".join(["%s, " % k for k in keys]), self.EXTRA_KEY))
+        return
+
+    def create_inode_index(self):
+        """
+        create the index on the inodes of the files-table
+        """
+        self.DB_BE.execute_statment("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" %
+                                    (self.SRC_INODE_INDEX, self.FILES_TABLE, self.SRC_INODE_KEY))
+        return
+
+    def read_files_keys(self):
+        """
+        read the columns of the files-table
+        """
+        self.ordered_files_keys = self.DB_BE.get_columns(self.FILES_TABLE)
+        self.files_key_set = set(self.ordered_files_keys)
+        # libraries without the extra-column have a column for every valid key
+        self.compact = self.EXTRA_KEY in self.files_key_set
+        # older libraries cannot store hard links
+        self.unique_inodes = self.SRC_INODE_KEY in \
+                             self.DB_BE.get_unique_columns(self.FILES_TABLE)
+        return
+
+    def get_view_keys(self):
+        """
+        return the valid keys used by the dirtree or the filename_generator
+        of any view, these are stored in columns of their own.
+        """
+        keys = []
+        for view in self.get_views().values():
+            for k in view["dirtree"] + self.get_fn_gen_keys(view):
+                if k in self.magix["valid_keys"] and not k in keys:
+                    keys.append(k)
+        return keys
+
+    def get_key_expr(self, key):
+        """
+        return the sql-expression reading a metadata key,
+        either its column or its value in the extra-column
+        """
+        if key in self.files_key_set:
+            return key
+        return "coalesce(json_extract(%s, '$.\"%s\"'), '%s')" % (self.EXTRA_KEY, key, self.UNKNOWN)
+
+    @calltrace_logger
+    def promote_keys(self, keys):
+        """
+        move metadata keys from the extra-column into columns of their own
+        """
+        if not self.compact:
+            return
+        new_keys = [k for k in keys if not k in self.files_key_set]
+        for k in new_keys:
+            LOGGER.debug("promote_keys: %s", k)
+            self.DB_BE.execute_statment("ALTER TABLE %s ADD COLUMN %s" % (self.FILES_TABLE, k))
+            self.DB_BE.execute_statment("UPDATE %s SET %s=%s, %s=json_remove(%s, '$.\"%s\"');" %
+                                        (self.FILES_TABLE, k, self.get_key_expr(k),
+                                         self.EXTRA_KEY, self.EXTRA_KEY, k))
+        self.DB_BE.commit()
+        if new_keys:
+            self.read_files_keys()
+            self.setup_queries()
+        return
+
+    @calltrace_logger
+    def migrate_files_table(self):
+        """
+        convert the files-table of an old library, which has a column
+        for every valid key or unique inodes, to the compact layout.
+        Afterwards, the trees-table is created if the library does not have one.
+        Returns the number of converted rows, None if there was nothing to do.
+        """
+        if self.compact and not self.unique_inodes:
+            self.setup_trees_table()
+            return None
+        keys = self.get_view_keys()
+        new_table = "%s_compact" % self.FILES_TABLE
+        old_columns = self.ordered_files_keys
+        new_columns = self.SRC_KEYS + keys + [self.EXTRA_KEY]
+        self.DB_BE.execute_statment("DROP TABLE IF EXISTS %s" % new_table)
+        self.create_files_table(new_table, keys)
+        insert_str = "INSERT INTO %s (%s) VALUES (%s)" % \
+                     (new_table, ",".join(new_columns), ",".join(["?" for k in new_columns]))
+        rows = []
+        num_rows = 0
+        # all in one transaction, so that an interrupted migration leaves the old table
+        # keep the order in which the files were added
+        for row in self.DB_BE.iter_query("SELECT %s FROM %s ORDER BY rowid;" %
+                                         (",".join(old_columns), self.FILES_TABLE),
+                                         writer=True):
+            values = dict(zip(old_columns, row))
+            extra = {}
+            if values.get(self.EXTRA_KEY) is not None:
+                extra = json.loads(values[self.EXTRA_KEY])
+            for k in old_columns:
+                if k in self.SRC_KEYS or k in keys or k == self.EXTRA_KEY:
+                    continue
+                if values[k] is not None and values[k] not in ["", self.UNKNOWN]:
+                    extra[k] = values[k]
+            rows.append([values[k] for k in self.SRC_KEYS + keys] +
+                        [json.dumps(extra) if extra else None])
+            if len(rows) >= self.BATCH_SIZE:
+                self.DB_BE.execute_many(insert_str, rows)
+                num_rows += len(rows)
+                rows = []
+        if rows:
+            self.DB_BE.execute_many(insert_str, rows)
+            num_rows += len(rows)
+        self.DB_BE.execute_statment("DROP TABLE %s" % self.FILES_TABLE)
+        self.DB_BE.execute_statment("ALTER TABLE %s RENAME TO %s" % (new_table, self.FILES_TABLE))
+        self.create_inode_index()
+        self.DB_BE.commit()
+        self.read_files_keys()
+        self.setup_queries()
+        # the indexes have been dropped together with the old table
+        self.sync_view_indexes()
+        self.setup_trees_table()
+        # give the space back
+        self.DB_BE.execute_statment("VACUUM")
+        return num_rows
+
+    def get_dirtree_index_name(self, dirtree):
+        """
+        return the name of the index on the columns of a dirtree
+        """
+        return "%s__%s" % (self.DIRTREE_INDEX_PREFIX, "__".join(dirtree))
+
+    @calltrace_logger
+    def sync_view_indexes(self):
+        """
+        create a composite index on the dirtree-columns for each view,
+        in the order of the dirtree. Drop those not used by any view anymore.
+        """
+        wanted = {}
+        for view in self.get_views().values():
+            wanted[self.get_dirtree_index_name(view["dirtree"])] = view["dirtree"]
+        res = self.DB_BE.execute_statment("SELECT name FROM sqlite_master WHERE type='index' "\
+                                          "AND tbl_name=? AND name LIKE ?;",
+                                          self.FILES_TABLE, "%s__%%" % self.DIRTREE_INDEX_PREFIX)
+        existing = set([tpl[0] for tpl in res])
+        for index_name in existing:
+            if not index_name in wanted:
+                LOGGER.debug("sync_view_indexes: dropping %s", index_name)
+                self.DB_BE.execute_statment("DROP INDEX %s" % index_name)
+        for index_name, dirtree in wanted.items():
+            if not index_name in existing:
+                LOGGER.debug("sync_view_indexes: creating %s", index_name)
+                self.DB_BE.execute_statment("CREATE INDEX %s ON %s (%s)" %
+                                            (index_name, self.FILES_TABLE, ",".join(dirtree)))
         self.DB_BE.commit()
         return
 
+    @calltrace_logger
+    def upgrade_files_table(self):
+        """
+        add the columns for the stat-info of the source files
+        to libraries created before they existed.
+        """
+        missing_keys = [k for k in [self.SRC_SIZE_KEY, self.SRC_MTIME_KEY]
+                        if not k in self.ordered_files_keys]
+        if not missing_keys:
+            return
+        if self.read_only:
+            sys.stderr.write("Library %s is too old for a read-only mount, "\
+                             "update it first.\n" % (self.DB_BE))
+            sys.exit(1)
+        for k in missing_keys:
+            self.DB_BE.execute_statment("ALTER TABLE %s ADD COLUMN %s integer" %
+                                        (self.FILES_TABLE, k))
+        self.DB_BE.commit()
+        self.read_files_keys()
+        return
+
+    @calltrace_logger
+    def setup_queries(self):
+        """
+        build the parameterized queries of the current view once,
+        so that the statements are found in the statement cache of the
+        db-backend instead of being parsed again on every call.
+        """
+        dirtree = self.current_view["dirtree"]
+        dirtree_exprs = [self.get_key_expr(k) for k in dirtree]
+        self.queries = {
+            "vtree": "SELECT DISTINCT %s FROM %s;" % (",".join(dirtree_exprs), self.FILES_TABLE),
+            "leaf": "SELECT %s, gen_name, dup, %s FROM %s WHERE view=? AND vdir=? ORDER BY rowid;" %
+                    (self.SRC_INODE_KEY, self.SRC_FILENAME_KEY, self.VTREE_TABLE),
+            "src_by_inode": "SELECT %s FROM %s WHERE %s=?;" %
+                            (self.SRC_FILENAME_KEY, self.FILES_TABLE, self.SRC_INODE_KEY),
+            "inode_by_src": "SELECT %s FROM %s WHERE %s=?;" %
+                            (self.SRC_INODE_KEY, self.FILES_TABLE, self.SRC_FILENAME_KEY),
+        }
+        # renaming a vdir on level i updates the first i+1 levels
+        self.update_column_queries = []
+        for i in range(len(dirtree)):
+            self.update_column_queries.append("UPDATE %s SET %s WHERE %s;" %
+                                              (self.FILES_TABLE,
+                                               ", ".join(["%s=?" % k for k in dirtree[:i+1]]),
+                                               " AND ".join(["%s=?" % k for k in dirtree[:i+1]])))
+        return
+
+    def get_fn_formatter(self, fn_gen):
+        """
+        return a tuple (template, keys) for a filename generator, see parse_fn_gen.
+        """
+        if not fn_gen in self.fn_formatters:
+            _, _, template, template_keys = self.parse_fn_gen(fn_gen)
+            self.fn_formatters[fn_gen] = (template, template_keys[1:])
+        return self.fn_formatters[fn_gen]
+
+    def get_fn_gen_keys(self, view):
+        """
+        return the keys of the filename generator of a view, which are stored in the db
+        """
+        return self.get_fn_formatter(view["fn_gen"])[1]
+
+    def generate_filename(self, template, src_filename, values):
+        """
+        return the filename generated by the template of get_fn_formatter
+        from the values of its keys
+        """
+        return template.format(os.path.basename(src_filename), *values)
+
+    @calltrace_logger
+    def setup_trees_table(self):
+        """
+        create and fill the trees-table, if the library does not have it yet
+        """
+        res = self.DB_BE.execute_query("SELECT name FROM sqlite_master WHERE type='table' "\
+                                       "AND name=?;", self.VTREE_TABLE)
+        if len(res) > 0:
+            return
+        if self.read_only:
+            sys.stderr.write("Library %s is too old for a read-only mount, "\
+                             "update it first.\n" % (self.DB_BE))
+            sys.exit(1)
+        self.DB_BE.execute_statment("CREATE TABLE %s (view varchar, vdir varchar, "\
+                                    "gen_name varchar, dup integer, %s integer, %s varchar)" %
+                                    (self.VTREE_TABLE, self.SRC_INODE_KEY, self.SRC_FILENAME_KEY))
+        # with gen_name, the duplicate counter of a new file is found quickly
+        self.DB_BE.execute_statment("CREATE INDEX %s ON %s (view, vdir, gen_name)" %
+                                    (self.VTREE_INDEX, self.VTREE_TABLE))
+        for view_name in self.get_views():
+            self.rebuild_view(view_name)
+        self.DB_BE.commit()
+        return
+
+    def iter_tree_entries(self, view, where_str, *args):
+        """
+        generate tuples (tuple of dirtree-values, gen_name, src_inode, src_filename)
+        of a view for the files matching where_str, ordered by directory
+        and the order the files were added.
+        """
+        dirtree = view["dirtree"]
+        template, fn_gen_keys = self.get_fn_formatter(view["fn_gen"])
+        columns = [self.get_key_expr(k) for k in dirtree] + \
+                  [self.SRC_INODE_KEY, self.SRC_FILENAME_KEY] + \
+                  [self.get_key_expr(k) for k in fn_gen_keys]
+        query_str = "SELECT %s FROM %s WHERE %s ORDER BY %s, rowid;" % \
+                    (",".join(columns), self.FILES_TABLE, where_str,
+                     ",".join([self.get_key_expr(k) for k in dirtree]))
+        num_dirs = len(dirtree)
+        # the trees are written in the same transaction as the files
+        for row in self.DB_BE.iter_query(query_str, *args, writer=True):
+            src_inode, src_filename = row[num_dirs], row[num_dirs + 1]
+            gen_name = self.generate_filename(template, src_filename, row[num_dirs + 2:])
+            yield tuple(row[:num_dirs]), gen_name, src_inode, src_filename
+
+    def iter_tree_rows(self, view_name, view, where_str, *args):
+        """
+        generate the rows of the trees-table of a view for the files
+        matching where_str. Files with the same generated filename in a
+        directory are numbered in the order they were added.
+        """
+        last_vdir = None
+        occurrences = {}
+        for vdir_values, gen_name, src_inode, src_filename in \
+                self.iter_tree_entries(view, where_str, *args):
+            vdir = "/".join(vdir_values)
+            if vdir != last_vdir:
+                last_vdir = vdir
+                occurrences = {}
+            dup = occurrences.get(gen_name, -1) + 1
+            occurrences[gen_name] = dup
+            yield view_name, vdir, gen_name, dup, src_inode, src_filename
+
+    def get_tree_entries(self, src_names):
+        """
+        return a dict (view_name, src_filename) -> (tuple of dirtree-values,
+        gen_name, src_inode) for the files with the given src_names in every view,
+        see iter_tree_entries. The files of a view are in the order of the trees.
+        """
+        entries = {}
+        for view_name, view in self.get_views().items():
+            for chunk in chunks(src_names):
+                for vdir_values, gen_name, src_inode, src_filename in \
+                        self.iter_tree_entries(view, "%s IN (%s)" %
+                                               (self.SRC_FILENAME_KEY,
+                                                ",".join(["?" for x in chunk])), *chunk):
+                    entries[(view_name, src_filename)] = (vdir_values, gen_name, src_inode)
+        return entries
+
+    def append_tree_rows(self, entries):
+        """
+        add the files, which have been added after all others in their
+        virtual directories, to the trees-table.
+        entries are tuples (view_name, vdir, gen_name, src_inode, src_filename)
+        in the order the files were added. Their duplicate counters continue
+        those of the files already in the directory.
+        """
+        gen_names = {}
+        for view_name, vdir, gen_name, src_inode, src_filename in entries:
+            gen_names.setdefault((view_name, vdir), set()).add(gen_name)
+        next_dups = {}
+        for (view_name, vdir), names in gen_names.items():
+            for chunk in chunks(list(names)):
+                res = self.DB_BE.execute_statment("SELECT gen_name, max(dup) FROM %s WHERE "\
+                                                  "view=? AND vdir=? AND gen_name IN (%s) "\
+                                                  "GROUP BY gen_name;" %
+                                                  (self.VTREE_TABLE,
+                                                   ",".join(["?" for x in chunk])),
+                                                  view_name, vdir, *chunk)
+                for gen_name, dup in res:
+                    next_dups[(view_name, vdir, gen_name)] = dup + 1
+        rows = []
+        for view_name, vdir, gen_name, src_inode, src_filename in entries:
+            key = (view_name, vdir, gen_name)
+            dup = next_dups.get(key, 0)
+            rows.append((view_name, vdir, gen_name, dup, src_inode, src_filename))
+            next_dups[key] = dup + 1
+        self.insert_tree_rows(rows)
+        return
+
+    def insert_tree_rows(self, rows):
+        """
+        write rows into the trees-table in batches
+        """
+        insert_str = "INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?)" % (self.VTREE_TABLE)
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.BATCH_SIZE:
+                self.DB_BE.execute_many(insert_str, batch)
+                batch = []
+        if batch:
+            self.DB_BE.execute_many(insert_str, batch)
+        return
+
+    @calltrace_logger
+    def rebuild_view(self, view_name):
+        """
+        regenerate the trees-table of a view, without committing
+        """
+        view = self.get_views()[view_name]
+        self.DB_BE.execute_statment("DELETE FROM %s WHERE view=?;" % (self.VTREE_TABLE), view_name)
+        self.insert_tree_rows(self.iter_tree_rows(view_name, view, "1"))
+        return
+
+    def get_touched_vdirs(self, where_str, *args):
+        """
+        return a set of (view_name, tuple of dirtree-values) of the
+        virtual directories containing the files matching where_str
+        """
+        touched = set()
+        for view_name, view in self.get_views().items():
+            res = self.DB_BE.iter_query("SELECT DISTINCT %s FROM %s WHERE %s;" %
+                                        (",".join([self.get_key_expr(k) for k in view["dirtree"]]),
+                                         self.FILES_TABLE, where_str), *args, writer=True)
+            for row in res:
+                touched.add((view_name, tuple(row)))
+        return touched
+
+    def get_touched_vdirs_of_files(self, src_names):
+        """
+        return the virtual directories, see get_touched_vdirs, containing
+        the files with the given src_names
+        """
+        touched = set()
+        for chunk in chunks(src_names):
+            touched |= self.get_touched_vdirs("%s IN (%s)" % (self.SRC_FILENAME_KEY,
+                                                              ",".join(["?" for x in chunk])),
+                                              *chunk)
+        return touched
+
+    @calltrace_logger
+    def rebuild_vdirs(self, touched):
+        """
+        regenerate the trees-table for the virtual directories
+        returned by get_touched_vdirs, without committing
+        """
+        vdirs_by_view = {}
+        for view_name, vdir_values in touched:
+            vdirs_by_view.setdefault(view_name, []).append(vdir_values)
+        for view_name, view in self.get_views().items():
+            vdirs = vdirs_by_view.get(view_name, [])
+            if not vdirs:
+                continue
+            self.DB_BE.execute_many("DELETE FROM %s WHERE view=? AND vdir=?;" % (self.VTREE_TABLE),
+                                    [(view_name, "/".join(vdir_values)) for vdir_values in vdirs])
+            # read the files of many directories at once
+            dirtree_exprs = [self.get_key_expr(k) for k in view["dirtree"]]
+            row_value = "(%s)" % ",".join(["?" for k in dirtree_exprs])
+            for chunk in chunks(vdirs, max(1, MAX_HOST_PARAMETERS // len(dirtree_exprs))):
+                # a plain "IN (VALUES ...)" would not be searched in the dirtree index
+                where_str = "(%s) IN (SELECT %s FROM (VALUES %s))" % \
+                            (",".join(dirtree_exprs),
+                             ",".join(["column%d" % (j + 1) for j in range(len(dirtree_exprs))]),
+                             ",".join([row_value for x in chunk]))
+                args = [value for vdir_values in chunk for value in vdir_values]
+                self.insert_tree_rows(self.iter_tree_rows(view_name, view, where_str, *args))
+        return
+
+    def has_changed(self):
+        """
+        check if the library has been changed by somebody else,
+        e.g. an update, since the last call.
+        A snapshot never changes.
+        """
+        if self.snapshot is not None:
+            return False
+        data_version = self.DB_BE.get_data_version()
+        if data_version == self.data_version:
+            return False
+        self.data_version = data_version
+        self.forget_src_files()
+        return True
+
+    def remember_src_file(self, src_inode, src_filename):
+        """
+        put a file into the in-memory src_inode <-> src_filename maps
+        """
+        self.src_by_inode[src_inode] = src_filename
+        self.inode_by_src[src_filename] = src_inode
+
+    def forget_src_file(self, src_inode=None, src_filename=None):
+        """
+        remove a file by src_inode and/or src_filename from
+        the in-memory maps
+        """
+        old_filename = self.src_by_inode.pop(src_inode, None)
+        if old_filename is not None:
+            self.inode_by_src.pop(old_filename, None)
+        old_inode = self.inode_by_src.pop(src_filename, None)
+        if old_inode is not None:
+            self.src_by_inode.pop(old_inode, None)
+
+    def forget_src_files(self):
+        """
+        empty the in-memory maps
+        """
+        if self.snapshot is None:
+            self.src_by_inode.clear()
+            self.inode_by_src.clear()
+
     @calltrace_logger
     def generate_vtree(self):
         """
@@ -284,9 +839,10 @@ class BusinessLogic:
             return vtree
 
         self.vtree = {}
-        res = self.DB_BE.execute_statment("SELECT DISTINCT %s from %s;" %
-                                          (",".join(self.current_view["dirtree"]),
-                                           self.FILES_TABLE))
+        if self.snapshot is not None:
+            res = self.snapshot.get_vdirs()
+        else:
+            res = self.DB_BE.iter_query(self.queries["vtree"])
         for tpl in res:
             self.vtree = build_dict(self.vtree, tpl)
         return
@@ -310,7 +866,7 @@ class BusinessLogic:
         check tables in database for validity.
         """
         # check FILES_TABLE for valid_keys
-        for k in [self.SRC_FILENAME_KEY, self.SRC_INODE_KEY]:
+        for k in self.SRC_KEYS:
             if not k in self.ordered_files_keys:
                 sys.stderr.write("Internal Error: Mandatory key %s does not exist in db %s.\n" %
                                  (k, self.DB_BE))
@@ -320,7 +876,7 @@ class BusinessLogic:
         LOGGER.debug("self.ordered_keys=%s", self.ordered_files_keys)
         LOGGER.debug("self.magix[valid_keys]=%s", self.magix["valid_keys"])
         for k in self.ordered_files_keys:
-            if k in [self.SRC_FILENAME_KEY, self.SRC_INODE_KEY]:
+            if k in self.SRC_KEYS or k == self.EXTRA_KEY:
                 continue
             if not k in self.magix["valid_keys"]:
                 sys.stderr.write("Internal Error: Key %s is not valid.\n" % k)
@@ -328,6 +884,8 @@ class BusinessLogic:
                 sys.stderr.write("Otherwise delete and recreate the library.\n")
                 sys.exit(1)
 
+        if self.compact:
+            return
         for k in self.magix["valid_keys"]:
             if not k in self.ordered_files_keys:
                 sys.stderr.write("Internal Error: Valid key %s does not exist in db %s.\n" %
@@ -358,68 +916,361 @@ class BusinessLogic:
         return self.current_view["dirtree"][len(vpath_list)]
 
     @calltrace_logger
-    def add_entry(self, src_filename, metadata):
+    def add_entry(self, src_filename, metadata, src_statinfo=None):
         """
         Adds a file-entry.
         """
-        src_statinfo = os.stat(src_filename)
-        metadata[self.SRC_FILENAME_KEY] = src_filename
-        metadata[self.SRC_INODE_KEY] = src_statinfo.st_ino
-        LOGGER.debug("metadata=%s", metadata)
+        self.add_entries([(src_filename, metadata, src_statinfo)])
+        return
+
+    def get_row_values(self, src_filename, metadata, src_statinfo=None):
+        """
+        return the values of a row in the files-table
+        in the order of self.ordered_files_keys
+        """
+        if src_statinfo is None:
+            src_statinfo = os.stat(src_filename)
+        extra = {}
+        if self.compact:
+            for k, value in metadata.items():
+                if k in self.files_key_set or not k in self.magix["valid_keys"]:
+                    continue
+                value = "%s" % (value,)
+                if len(value) > 0:
+                    extra[k] = value
         values = []
         for k in self.ordered_files_keys:
-            try:
-                values.append("%s" % metadata.get(k, self.UNKNOWN))
-            except:
-                sys.stderr.write("Ignoring Key %s, Values %s is not a string."\
-                                 % (k, (metadata[k],)))
-        # changing a list within a loop over itself,
-        # huuu, but this should work
-        for i, item  in enumerate(values):
-            if len(item) == 0:
-                values[i] = self.UNKNOWN
-        values_param_str = ",".join(["?" for x in values])
+            if k == self.SRC_FILENAME_KEY:
+                values.append(src_filename)
+            elif k == self.SRC_INODE_KEY:
+                values.append(src_statinfo.st_ino)
+            elif k == self.SRC_SIZE_KEY:
+                values.append(src_statinfo.st_size)
+            elif k == self.SRC_MTIME_KEY:
+                values.append(src_statinfo.st_mtime_ns)
+            elif k == self.EXTRA_KEY:
+                values.append(json.dumps(extra) if extra else None)
+            else:
+                value = "%s" % (metadata.get(k, self.UNKNOWN),)
+                if len(value) == 0:
+                    value = self.UNKNOWN
+                values.append(value)
+        return values
 
+    @calltrace_logger
+    def add_entries(self, entries, batch_size=BATCH_SIZE):
+        """
+        Adds or updates many file-entries.
+        entries is an iterable of tuples (src_filename, metadata, src_statinfo),
+        src_statinfo may be None.
+        The rows are written in batches of batch_size, each in
+        a single transaction.
+        Returns a tuple (number of inserted, number of updated) rows.
+        """
+        filename_idx = self.ordered_files_keys.index(self.SRC_FILENAME_KEY)
+        inserted = updated = 0
+        # rows by src_filename
+        batch = {}
+        for src_filename, metadata, src_statinfo in entries:
+            LOGGER.debug("add_entries: %s metadata=%s", src_filename, metadata)
+            values = self.get_row_values(src_filename, metadata, src_statinfo)
+            batch[values[filename_idx]] = values
+            if len(batch) >= batch_size:
+                _inserted, _updated = self.write_batch(list(batch.values()))
+                inserted += _inserted
+                updated += _updated
+                batch = {}
+        if batch:
+            _inserted, _updated = self.write_batch(list(batch.values()))
+            inserted += _inserted
+            updated += _updated
+        return inserted, updated
+
+    def write_batch(self, rows):
+        """
+        upsert rows of the files-table, with distinct src_filenames,
+        update the trees and commit them in a single transaction.
+        Returns a tuple (number of inserted, number of updated) rows.
+        """
+        filename_idx = self.ordered_files_keys.index(self.SRC_FILENAME_KEY)
+        inode_idx = self.ordered_files_keys.index(self.SRC_INODE_KEY)
+        src_names = [values[filename_idx] for values in rows]
+        with self.DB_BE.transaction():
+            existing = self.get_existing_src_names(src_names)
+            old_entries = self.get_tree_entries(list(existing))
+            # a file which has been moved keeps its inode,
+            # so replace the entry of its old name
+            moved = self.get_moved_src_names([values[inode_idx] for values in rows], src_names)
+            dirty = self.get_touched_vdirs_of_files(moved)
+            self.DB_BE.execute_many("DELETE FROM %s WHERE %s=?" %
+                                    (self.FILES_TABLE, self.SRC_FILENAME_KEY),
+                                    [(src_name,) for src_name in moved])
+            failed = self.upsert_rows(rows)
+            self.update_tree_entries(src_names, old_entries, dirty)
+            self.DB_BE.commit()
+        for src_name in moved:
+            self.forget_src_file(src_filename=src_name)
+        # only update files already in the maps, so that they
+        # do not grow during a large update
+        for values in rows:
+            src_inode, src_filename = values[inode_idx], values[filename_idx]
+            if src_inode in self.src_by_inode or src_filename in self.inode_by_src:
+                self.forget_src_file(src_inode, src_filename)
+                self.remember_src_file(src_inode, src_filename)
+        return len(rows) - len(existing) - failed, len(existing)
+
+    def upsert_rows(self, rows):
+        """
+        insert rows into the files-table or replace those with the same src_filename,
+        without committing. Returns the number of rows which could not be written.
+        """
+        update_str = ", ".join(["%s=excluded.%s" % (k, k) for k in self.ordered_files_keys
+                                if k != self.SRC_FILENAME_KEY])
+        query_str = "INSERT INTO %s VALUES (%s) ON CONFLICT(%s) DO UPDATE SET %s" % \
+                    (self.FILES_TABLE, ",".join(["?" for k in self.ordered_files_keys]),
+                     self.SRC_FILENAME_KEY, update_str)
         try:
-            LOGGER.debug("ordered_files_keys = %s", self.ordered_files_keys)
-            query_str = "INSERT INTO %s VALUES (%s)" % (self.FILES_TABLE, values_param_str)
-            self.DB_BE.execute_statment(query_str, *values)
+            self.DB_BE.execute_many(query_str, rows)
         except self.DB_BE.IntegrityError:
-            update_str = ""
-            for k in self.ordered_files_keys:
-                update_str += "%s=?, " % (k)
-            update_str = update_str[:-2]
-            values.append(src_filename)
-            query_str = "UPDATE %s SET %s WHERE src_filename=?" % (self.FILES_TABLE, update_str)
-            self.DB_BE.execute_statment(query_str, *values)
-        self.DB_BE.commit()
-        # revert modifications to metadata
-        metadata.pop(self.SRC_FILENAME_KEY)
-        metadata.pop(self.SRC_INODE_KEY)
+            pass
+        else:
+            return 0
+        # in a library with unique inodes, a hard link of a file
+        # already in it cannot be added. Write the rows one by one
+        # to skip only the offending ones
+        filename_idx = self.ordered_files_keys.index(self.SRC_FILENAME_KEY)
+        failed = 0
+        for values in rows:
+            try:
+                self.DB_BE.execute_statment(query_str, *values)
+            except self.DB_BE.IntegrityError as excep:
+                LOGGER.warning("cannot add file: %s. Exception=%s. "\
+                               "Migrate the library to keep hard links.",
+                               values[filename_idx], excep)
+                failed += 1
+        return failed
+
+    def update_tree_entries(self, src_names, old_entries, dirty):
+        """
+        bring the trees up to date after the files with src_names have been
+        written, without committing.
+        old_entries are their entries before, see get_tree_entries.
+        The virtual directories in dirty, see get_touched_vdirs, and those which
+        some files leave or join out of the order they were added are regenerated.
+        New files are appended, changed inodes are updated in place.
+        """
+        appended = []
+        new_inodes = []
+        for (view_name, src_filename), (vdir_values, gen_name, src_inode) in \
+                self.get_tree_entries(src_names).items():
+            old_entry = old_entries.get((view_name, src_filename))
+            if old_entry is None:
+                appended.append((view_name, vdir_values, gen_name, src_inode, src_filename))
+            elif old_entry[:2] != (vdir_values, gen_name):
+                dirty.add((view_name, old_entry[0]))
+                dirty.add((view_name, vdir_values))
+            elif old_entry[2] != src_inode:
+                new_inodes.append((view_name, vdir_values, gen_name, src_inode, src_filename))
+        self.rebuild_vdirs(dirty)
+        # the regenerated directories contain these files already
+        self.append_tree_rows([(view_name, "/".join(vdir_values), gen_name, src_inode,
+                                src_filename)
+                               for view_name, vdir_values, gen_name, src_inode, src_filename
+                               in appended if not (view_name, vdir_values) in dirty])
+        self.DB_BE.execute_many("UPDATE %s SET %s=? WHERE view=? AND vdir=? AND "\
+                                "gen_name=? AND %s=?;" %
+                                (self.VTREE_TABLE, self.SRC_INODE_KEY, self.SRC_FILENAME_KEY),
+                                [(src_inode, view_name, "/".join(vdir_values), gen_name,
+                                  src_filename)
+                                 for view_name, vdir_values, gen_name, src_inode, src_filename
+                                 in new_inodes if not (view_name, vdir_values) in dirty])
         return
 
+    @calltrace_logger
+    def get_existing_src_names(self, src_names):
+        """
+        return the subset of src_names which is already in the db
+        """
+        existing = set()
+        for chunk in chunks(src_names):
+            res = self.DB_BE.execute_statment("SELECT %s FROM %s WHERE %s IN (%s);" %
+                                              (self.SRC_FILENAME_KEY, self.FILES_TABLE,
+                                               self.SRC_FILENAME_KEY,
+                                               ",".join(["?" for x in chunk])), *chunk)
+            existing.update([tpl[0] for tpl in res])
+        return existing
+
+    @calltrace_logger
+    def get_moved_src_names(self, src_inodes, src_names):
+        """
+        return the names of the entries with one of src_inodes, which are
+        not in src_names and do not exist anymore, i.e. the old names of
+        moved files
+        """
+        moved = []
+        src_names = set(src_names)
+        for chunk in chunks(src_inodes):
+            res = self.DB_BE.execute_statment("SELECT %s FROM %s WHERE %s IN (%s);" %
+                                              (self.SRC_FILENAME_KEY, self.FILES_TABLE,
+                                               self.SRC_INODE_KEY,
+                                               ",".join(["?" for x in chunk])), *chunk)
+            moved.extend([tpl[0] for tpl in res
+                          if not tpl[0] in src_names and not os.path.lexists(tpl[0])])
+        return moved
+
     @calltrace_logger
     def remove_entry(self, src_filename):
         """
         removes a file-entry
         """
-        self.DB_BE.execute_statment("DELETE from %s WHERE src_filename=?" %
-                                    (self.FILES_TABLE), src_filename)
+        self.remove_entries([src_filename])
+        return
+
+    @calltrace_logger
+    def remove_entries(self, src_names):
+        """
+        removes many file-entries in a single transaction
+        """
+        src_names = list(src_names)
+        with self.DB_BE.transaction():
+            touched = self.get_touched_vdirs_of_files(src_names)
+            self.DB_BE.execute_many("DELETE from %s WHERE src_filename=?" % (self.FILES_TABLE),
+                                    [(src_name,) for src_name in src_names])
+            self.rebuild_vdirs(touched)
+            self.DB_BE.commit()
+        for src_name in src_names:
+            self.forget_src_file(src_filename=src_name)
+        return
+
+    @calltrace_logger
+    def remove_entries_below(self, directory):
+        """
+        removes all file-entries below a source directory
+        """
+        with self.DB_BE.transaction():
+            where, args = self.get_prefix_where(directory)
+            touched = self.get_touched_vdirs(where, *args)
+            self.DB_BE.execute_statment("DELETE from %s WHERE %s" % (self.FILES_TABLE, where),
+                                        *args)
+            self.rebuild_vdirs(touched)
+            self.DB_BE.commit()
+        self.forget_src_files()
+        return
+
+    @calltrace_logger
+    def create_checkpoints_table(self):
+        """
+        create the table for the checkpoints, if it does not exist yet
+        """
+        self.DB_BE.execute_statment("CREATE TABLE IF NOT EXISTS %s (source varchar, "\
+                                    "directory varchar, PRIMARY KEY (source, directory))" %
+                                    (self.CHECKPOINTS_TABLE))
+        return
+
+    @calltrace_logger
+    def get_checkpoints(self, source):
+        """
+        return the set of directories which have been completely
+        written by a previous update of source
+        """
+        self.create_checkpoints_table()
+        res = self.DB_BE.execute_statment("SELECT directory FROM %s WHERE source=?;" %
+                                          (self.CHECKPOINTS_TABLE), source)
+        return set([tpl[0] for tpl in res])
+
+    def add_checkpoint(self, source, directory):
+        """
+        remember that all files of directory have been written.
+        This is not committed on its own, but with the next batch of entries,
+        which contains the last of them.
+        """
+        self.DB_BE.execute_statment("INSERT OR IGNORE INTO %s (source, directory) VALUES (?, ?)" %
+                                    (self.CHECKPOINTS_TABLE), source, directory)
+        return
+
+    @calltrace_logger
+    def clear_checkpoints(self, source):
+        """
+        forget the checkpoints of source
+        """
+        self.create_checkpoints_table()
+        self.DB_BE.execute_statment("DELETE FROM %s WHERE source=?;" %
+                                    (self.CHECKPOINTS_TABLE), source)
         self.DB_BE.commit()
         return
 
+    @calltrace_logger
+    def start_scan(self):
+        """
+        prepare an empty temporary table for the files found by a scan
+        """
+        self.DB_BE.execute_statment("CREATE TEMP TABLE IF NOT EXISTS %s (%s varchar primary key)" %
+                                    (self.SEEN_TABLE, self.SRC_FILENAME_KEY))
+        self.DB_BE.execute_statment("DELETE FROM temp.%s" % (self.SEEN_TABLE))
+        return
+
+    @calltrace_logger
+    def mark_seen(self, src_names):
+        """
+        remember src_names as found by the current scan.
+        This is not committed on its own, but with the next batch of entries.
+        """
+        self.DB_BE.execute_many("INSERT OR IGNORE INTO temp.%s VALUES (?)" % (self.SEEN_TABLE),
+                                [(src_name,) for src_name in src_names])
+        return
+
+    @calltrace_logger
+    def mark_seen_below(self, directory):
+        """
+        remember all entries below the directory as found by the current scan
+        """
+        where, args = self.get_prefix_where(os.path.abspath(directory))
+        self.DB_BE.execute_statment("INSERT OR IGNORE INTO temp.%s SELECT %s FROM %s WHERE %s;" %
+                                    (self.SEEN_TABLE, self.SRC_FILENAME_KEY, self.FILES_TABLE,
+                                     where), *args)
+        return
+
+    @calltrace_logger
+    def remove_unseen(self, source, dry_run=False):
+        """
+        remove all entries below the directory source, which
+        have not been found by the current scan.
+        Everything is done in a single statement and transaction.
+        With dry_run, only count them.
+        Returns the number of obsolete entries.
+        """
+        where, args = self.get_prefix_where(os.path.abspath(source))
+        where += " AND %s NOT IN (SELECT %s FROM temp.%s)" % \
+                 (self.SRC_FILENAME_KEY, self.SRC_FILENAME_KEY, self.SEEN_TABLE)
+        with self.DB_BE.transaction():
+            res = self.DB_BE.execute_statment("SELECT COUNT(*) FROM %s WHERE %s;" %
+                                              (self.FILES_TABLE, where), *args)
+            obsolete = res[0][0]
+            if not dry_run and obsolete > 0:
+                touched = self.get_touched_vdirs(where, *args)
+                self.DB_BE.execute_statment("DELETE FROM %s WHERE %s;" %
+                                            (self.FILES_TABLE, where), *args)
+                self.rebuild_vdirs(touched)
+                self.forget_src_files()
+            self.DB_BE.commit()
+        return obsolete
+
     @calltrace_logger
     def get_entry(self, src_filename):
         """
-        returns the metadata to a src_filename
+        returns the metadata to a src_filename as a dict
         """
         try:
             query_str = "SELECT %s FROM %s WHERE src_filename=?;" % \
-               (",".join(["?" for x in self.ordered_files_keys]), self.FILES_TABLE)
-            res = self.DB_BE.execute_statment(query_str, self.ordered_files_keys, src_filename)
-            return res[0]
+               (",".join(self.ordered_files_keys), self.FILES_TABLE)
+            res = self.DB_BE.execute_query(query_str, src_filename)
+            entry = dict(zip(self.ordered_files_keys, res[0]))
         except IndexError:
             return None
+        extra = entry.pop(self.EXTRA_KEY, None)
+        if extra is not None:
+            entry.update(json.loads(extra))
+        return entry
 
     @calltrace_logger
     def update_column(self, old_vpath_list, new_vpath_list):
@@ -428,18 +1279,16 @@ class BusinessLogic:
         """
         assert len(old_vpath_list) == len(new_vpath_list)
         assert old_vpath_list != new_vpath_list
-        where = ""
-        update = ""
-        for i, old_item in enumerate(old_vpath_list):
-            new_item = new_vpath_list[i]
-            LOGGER.debug("comparing old %s to new %s", old_item, new_item)
-            where += "%s='%s' AND " % (self.current_view["dirtree"][i], old_item)
-            if old_item != new_item:
-                update += "%s='%s', " % (self.current_view["dirtree"][i], new_item)
-        where = where[:-len("AND ")]
-        update = update[:-len(", ")]
-        self.DB_BE.execute_statment("UPDATE %s set %s WHERE %s" % (self.FILES_TABLE, update, where))
-        self.DB_BE.commit()
+        LOGGER.debug("update_column: %s -> %s", old_vpath_list, new_vpath_list)
+        dirtree = self.current_view["dirtree"][:len(old_vpath_list)]
+        where = " AND ".join(["%s=?" % k for k in dirtree])
+        with self.DB_BE.transaction():
+            touched = self.get_touched_vdirs(where, *old_vpath_list)
+            query_str = self.update_column_queries[len(old_vpath_list) - 1]
+            self.DB_BE.execute_statment(query_str, *(new_vpath_list + old_vpath_list))
+            touched |= self.get_touched_vdirs(where, *new_vpath_list)
+            self.rebuild_vdirs(touched)
+            self.DB_BE.commit()
         return
 
     @calltrace_logger
@@ -449,9 +1298,9 @@ class BusinessLogic:
         are created.
         """
         try:
-            res = self.DB_BE.execute_statment("select name, json from %s WHERE name='%s';" %
-                                              (self.VIEWS_TABLE, view_name))
-            return json.loads(res[0])
+            res = self.DB_BE.execute_query("select json from %s WHERE name=?;" %
+                                           (self.VIEWS_TABLE), view_name)
+            return json.loads(res[0][0])
         except IndexError:
             return None
         return
@@ -465,28 +1314,88 @@ class BusinessLogic:
         for subdir in view["dirtree"]:
             if not subdir in self.magix["valid_keys"]:
                 raise RuntimeError("set_view: Key %s is not valid." % subdir)
-        self.DB_BE.execute_statment("insert into %s (name, json) values (%s, '%s')" %
-                                    (self.VIEWS_TABLE, view_name, json.dumps(view)))
+        self.DB_BE.execute_statment("insert into %s (name, json) values (?, ?)" %
+                                    (self.VIEWS_TABLE), view_name, json.dumps(view))
+        self.DB_BE.commit()
+        self.promote_keys(self.get_view_keys())
+        self.sync_view_indexes()
+        self.rebuild_view(view_name)
         self.DB_BE.commit()
         return
 
+    @calltrace_logger
+    def remove_view(self, view_name):
+        """
+        removes a view and the indexes only it used
+        """
+        if view_name == self.DEFAULT_VIEW_NAME:
+            raise RuntimeError("remove_view: The default view cannot be removed.")
+        self.DB_BE.execute_statment("DELETE FROM %s WHERE name=?" % (self.VIEWS_TABLE), view_name)
+        self.DB_BE.execute_statment("DELETE FROM %s WHERE view=?" % (self.VTREE_TABLE), view_name)
+        self.DB_BE.commit()
+        self.sync_view_indexes()
+        return
+
+    @calltrace_logger
+    def get_views(self):
+        """
+        return a dict of all views by name
+        """
+        res = self.DB_BE.execute_query("SELECT name, json FROM %s;" % (self.VIEWS_TABLE))
+        return {name: json.loads(view) for name, view in res}
+
     @calltrace_logger
     def get_all_src_names(self):
         """
         return list of all src_names in db
         """
-        res = self.DB_BE.execute_statment("SELECT %s FROM %s;" %
-                                          (self.SRC_FILENAME_KEY, self.FILES_TABLE))
+        res = self.DB_BE.iter_query("SELECT %s FROM %s;" %
+                                    (self.SRC_FILENAME_KEY, self.FILES_TABLE))
         return [tpl[0] for tpl in res]
 
+    def get_prefix_where(self, directory):
+        """
+        return a tuple (where_str, args) selecting the entries below a
+        source directory. It is a range of src_filename, so that its index is used.
+        """
+        prefix = os.path.join(directory, "")
+        # the character following the separator ends the range
+        upper = prefix[:-1] + chr(ord(os.sep) + 1)
+        return "%s >= ? AND %s < ?" % (self.SRC_FILENAME_KEY, self.SRC_FILENAME_KEY), \
+               [prefix, upper]
+
+    @calltrace_logger
+    def get_src_stats(self, directory):
+        """
+        return a dict src_filename -> (size, mtime_ns, inode)
+        of the files directly in a source directory,
+        as recorded when the entries were added.
+        """
+        where, args = self.get_prefix_where(directory)
+        res = self.DB_BE.execute_query("SELECT %s, %s, %s, %s FROM %s WHERE %s "\
+                                       "AND instr(substr(%s, ?), ?) = 0;" %
+                                       (self.SRC_FILENAME_KEY, self.SRC_SIZE_KEY,
+                                        self.SRC_MTIME_KEY, self.SRC_INODE_KEY,
+                                        self.FILES_TABLE, where, self.SRC_FILENAME_KEY),
+                                       *(args + [len(args[0]) + 1, os.sep]))
+        return {tpl[0]: tpl[1:] for tpl in res}
+
     @calltrace_logger
     def get_srcfilename_by_srcinode(self, inode):
         """
-        return src_filename
+        return src_filename.
+        Files listed before are found in memory, the others in the db.
+        Raises OSError with ENOENT for an unknown inode.
         """
-        res = self.DB_BE.execute_statment("SELECT %s FROM %s WHERE %s=%s;" %
-                                          (self.SRC_FILENAME_KEY, self.FILES_TABLE,
-                                           self.SRC_INODE_KEY, inode))
+        try:
+            return self.src_by_inode[inode]
+        except KeyError:
+            if self.snapshot is not None:
+                raise OSError(errno.ENOENT, "no file with inode %s" % inode)
+        res = self.DB_BE.execute_query(self.queries["src_by_inode"], inode)
+        if not res:
+            raise OSError(errno.ENOENT, "no file with inode %s" % inode)
+        self.remember_src_file(inode, res[0][0])
         return res[0][0]
 
     @calltrace_logger
@@ -505,57 +1414,65 @@ class BusinessLogic:
     # actually used for FUSE
     #
 
-    def get_gen_filename(self, src_filename):
+    def setup_filename_parsing(self):
         """
-        generate a virtual filename
+        compile the regular expression for the filename parsing
+        and the formatter of the current view
         """
-        gen_fn = self.current_view["fn_gen"]
-        gen_fn = gen_fn.replace("%{src_filename}", os.path.basename(src_filename))
-        query_str = "SELECT %s FROM %s WHERE src_filename=?;" % \
-                    (",".join(self.magix["valid_keys"]), self.FILES_TABLE)
-        res = self.DB_BE.execute_statment(query_str, src_filename)
-        all_file_keys = res[0]
-        LOGGER.debug("get_gen_filename src_filename:%s all_file_keys:%s",
-                     src_filename, all_file_keys)
-        for i, item in enumerate(self.magix["valid_keys"]):
-            gen_fn = gen_fn.replace("%%{%s}" % (item), all_file_keys[i])
-        return gen_fn
+        self.fn_gen_keys, reg_ex, template, template_keys = \
+            self.parse_fn_gen(self.current_view["fn_gen"])
+        self.fn_regex = re.compile(reg_ex)
+        self.fn_formatters[self.current_view["fn_gen"]] = (template, template_keys[1:])
+        return
 
-    def setup_filename_parsing(self):
+    def parse_fn_gen(self, fn_generator):
         """
-        compile the regular expression for the filename parsing
+        parse a filename generator.
+        Returns a tuple (fn_gen_keys, reg_ex, template, template_keys):
+        the keys in the order they appear, a regular expression with a group
+        for each of them, and a str.format-template with a positional field
+        for each of template_keys. The first template key is always src_filename,
+        the others are the valid keys used. Other keys are left as they are.
         """
         i = 0
         inside_key = False
         this_key = ""
-        self.fn_gen_keys = []
-        fn_generator = self.current_view["fn_gen"]
+        fn_gen_keys = []
+        template_keys = [self.SRC_FILENAME_KEY]
         reg_ex = ""
+        template = ""
         # create a regex and key mapping
         while i < len(fn_generator):
             if inside_key:
                 if fn_generator[i] == "}":
                     inside_key = False
-                    self.fn_gen_keys.append(this_key)
+                    fn_gen_keys.append(this_key)
+                    if this_key == self.SRC_FILENAME_KEY or this_key in self.magix["valid_keys"]:
+                        if not this_key in template_keys:
+                            template_keys.append(this_key)
+                        template += "{%d}" % template_keys.index(this_key)
+                    else:
+                        template += "%%{{%s}}" % this_key.replace("{", "{{").replace("}", "}}")
                 else:
                     this_key += fn_generator[i]
                 i += 1
                 continue
 
-            if fn_generator[i] == "%":
-                try:
-                    if fn_generator[i+1] == "{":
-                        inside_key = True
-                        i += 2
-                        this_key = ""
-                        reg_ex += "(.*)"
-                        continue
-                except IndexError:
-                    pass
-            reg_ex += fn_generator[i]
-            i += 1
-        self.fn_regex = re.compile(reg_ex)
-        return
+            if fn_generator.startswith("%{", i):
+                inside_key = True
+                i += 2
+                this_key = ""
+                reg_ex += "(.*)"
+                continue
+            if fn_generator.startswith("%%", i):
+                literal = "%"
+                i += 2
+            else:
+                literal = fn_generator[i]
+                i += 1
+            reg_ex += re.escape(literal)
+            template += literal.replace("{", "{{").replace("}", "}}")
+        return fn_gen_keys, reg_ex, template, template_keys
 
     @calltrace_logger
     def get_metadata_from_gen_filename(self, gen_filename):
@@ -602,21 +1519,16 @@ class BusinessLogic:
 
         # we are at the end of the tree
         if dir_level == self.max_dir_level:
-            where = ""
-            for i, item in enumerate(vpath_list):
-                where += "%s='%s' AND " % (self.current_view["dirtree"][i], item)
-            where = where[:-len("AND ")]
-            res = self.DB_BE.execute_statment("SELECT src_inode, src_filename FROM %s WHERE %s;" %
-                                              (self.FILES_TABLE, where))
-            file_name_occurrences = {}
-            for src_inode, src_filename in res:
-                file_vname = self.get_gen_filename(src_filename)
-                if file_vname in file_name_occurrences:
-                    file_name_occurrences[file_vname] += 1
-                    file_vname = "%s (libfs:%d)" % (file_vname, file_name_occurrences[file_vname])
-                else:
-                    file_name_occurrences[file_vname] = 0
-                contents.append((src_inode, file_vname, src_filename))
+            if self.snapshot is not None:
+                contents.extend(self.snapshot.get_leaf(vpath_list))
+            else:
+                for src_inode, gen_name, dup, src_filename in \
+                        self.DB_BE.iter_query(self.queries["leaf"], self.current_view_name,
+                                              "/".join(vpath_list)):
+                    if dup > 0:
+                        gen_name = self.DUPLICATE_NAME % (gen_name, dup)
+                    contents.append((src_inode, gen_name, src_filename))
+                    self.remember_src_file(src_inode, src_filename)
         else: # in vtree
             for val in self.seek_vtree(vpath_list=vpath_list):
                 # path within a vdir must not be empty,
@@ -632,8 +1544,13 @@ class BusinessLogic:
         """
         return the inode from a src_filename, callend by rename
         """
-        res = self.DB_BE.execute_statment("SELECT src_inode FROM %s WHERE src_filename=?;" %
-                                          (self.FILES_TABLE), src_filename)
+        try:
+            return self.inode_by_src[src_filename]
+        except KeyError:
+            if self.snapshot is not None:
+                raise
+        res = self.DB_BE.execute_query(self.queries["inode_by_src"], src_filename)
         LOGGER.debug("result = %s", res)
         assert len(res) == 1
+        self.remember_src_file(res[0][0], src_filename)
         return res[0][0]
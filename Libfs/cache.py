@@ -6,15 +6,25 @@ Copyright ©  Nikolaus Rath <Nikolaus.org>
 """
 
 import logging
+import time
 from llfuse import ROOT_INODE, FUSEError
-from threading import Lock
-from collections import defaultdict
+from threading import Lock, RLock
+from collections import defaultdict, OrderedDict
 import errno
 
 from Libfs.misc import calltrace_logger, filename_has_duplicate_counter
 
 LOGGER = logging.getLogger(__name__)
 
+# number of directory listings kept
+DEFAULT_LISTING_CACHE_SIZE = 1024
+# seconds after which a listing is read again
+DEFAULT_LISTING_CACHE_AGE = 30
+# number of stat-infos of source files kept
+DEFAULT_STAT_CACHE_SIZE = 65536
+# seconds after which a source file is stat'ed again
+DEFAULT_STAT_CACHE_TTL = 5
+
 class Memcache:
     """
     A simple memcache to store inode to path or filedescriptor mappings
@@ -145,3 +155,112 @@ class Memcache:
             self.inode2vpath_map[inode] = self.inode2vpath_map[inode].replace(old_path, new_path)
         LOGGER.debug("update_maps: %s", self.inode2vpath_map)
         return
+
+
+class TimedLRUCache:
+    """
+    Keeps the least recently used values by key.
+    Values older than max_age seconds are dropped.
+    """
+
+    def __init__(self, max_size, max_age):
+        self.max_size = max_size
+        self.max_age = max_age
+        # key -> (time added, value)
+        self.items = OrderedDict()
+        self.lock = RLock()
+
+    def get(self, key):
+        """
+        return the cached value of key, None if there is none
+        """
+        with self.lock:
+            try:
+                added, value = self.items[key]
+            except KeyError:
+                return None
+            if time.monotonic() - added > self.max_age:
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        cache the value of key, drop the least recently used
+        if there are too many
+        """
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.items[key] = (time.monotonic(), value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        drop the value of key
+        """
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        """
+        drop all values
+        """
+        with self.lock:
+            self.items.clear()
+
+
+class ListingCache(TimedLRUCache):
+    """
+    directory listings by vpath
+    """
+
+    def __init__(self, max_size=DEFAULT_LISTING_CACHE_SIZE, max_age=DEFAULT_LISTING_CACHE_AGE):
+        super().__init__(max_size, max_age)
+        # counts the invalidations, so that a listing read
+        # before one of them is not cached afterwards
+        self.generation = 0
+
+    def put(self, key, value, generation=None):
+        """
+        cache the listing of key, unless listings have been invalidated
+        since generation was read. Returns False in that case.
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return False
+            super().put(key, value)
+        return True
+
+    def invalidate(self, vpath, below=False):
+        """
+        drop the listing of vpath, with below also those of all
+        directories below it
+        """
+        with self.lock:
+            self.generation += 1
+            self.items.pop(vpath, None)
+            if below:
+                prefix = vpath.rstrip("/") + "/"
+                for path in [p for p in self.items if p.startswith(prefix)]:
+                    del self.items[path]
+
+    def clear(self):
+        """
+        drop all listings
+        """
+        with self.lock:
+            self.generation += 1
+            self.items.clear()
+
+
+class StatCache(TimedLRUCache):
+    """
+    stat-infos of source files by path
+    """
+
+    def __init__(self, max_size=DEFAULT_STAT_CACHE_SIZE, max_age=DEFAULT_STAT_CACHE_TTL):
+        super().__init__(max_size, max_age)
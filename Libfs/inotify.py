@@ -0,0 +1,118 @@
+"""
+minimal ctypes-wrapper around the inotify API of Linux
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+
+LOGGER = logging.getLogger(__name__)
+
+# event masks, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+# flags for inotify_init1
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# struct inotify_event without the trailing name
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+_LIBC = None
+
+def get_libc():
+    """
+    return the libc, load it only once
+    """
+    global _LIBC
+    if _LIBC is None:
+        _LIBC = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(_LIBC, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available on this system")
+        _LIBC.inotify_init1.argtypes = [ctypes.c_int]
+        _LIBC.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _LIBC.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return _LIBC
+
+class Inotify:
+    """
+    an inotify instance with its watches
+    """
+
+    def __init__(self):
+        """
+        create the inotify instance
+        """
+        self.libc = get_libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def fileno(self):
+        """
+        return the file descriptor, e.g. for select
+        """
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """
+        watch path for the events in mask, return the watch descriptor
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        """
+        remove a watch. The watch may already be gone, e.g. if the
+        directory has been deleted.
+        """
+        if self.libc.inotify_rm_watch(self.fd, wd) < 0:
+            LOGGER.debug("inotify_rm_watch %s: errno %s", wd, ctypes.get_errno())
+
+    def read_events(self):
+        """
+        return a list of all pending events as tuples (wd, mask, cookie, name)
+        """
+        events = []
+        try:
+            buf = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return events
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(buf[pos:pos + length].rstrip(b"\0"))
+            pos += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        """
+        close the inotify instance, removing all watches
+        """
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
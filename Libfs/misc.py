@@ -60,7 +60,7 @@ def calltrace_logger(func):
             logger.debug('%s </%s>', this_indent, class_name)
             CALLTRACE_STATE[threading.get_ident()] -= 1
             raise excep
-        logger.debug('%s <result><![CDATA[%s]]></result>', this_indent, ("%s" % result))
+        logger.debug('%s <result><![CDATA[%s]]></result>', this_indent, ("%s" % (result,)))
         logger.debug('%s </%s>', this_indent, class_name)
         CALLTRACE_STATE[threading.get_ident()] -= 1
         return result
@@ -1,5 +1,11 @@
 """
 Operations class containing the RequestHandlers for llfuse
+
+The handlers are called with the global llfuse.lock held.
+Blocking calls on the source files and read-only queries,
+which run on a connection of their own in each worker thread,
+are done with the lock released, so that several workers
+can serve requests at the same time.
 """
 import os
 import sys
@@ -10,32 +16,52 @@ from time import localtime, mktime
 from llfuse import FUSEError
 from os import fsencode, fsdecode
 from Libfs.misc import calltrace_logger, get_vpath_list
-from Libfs.cache import Memcache
+from Libfs.cache import Memcache, ListingCache, StatCache, DEFAULT_STAT_CACHE_SIZE, \
+    DEFAULT_STAT_CACHE_TTL
 from Libfs.business_logic import BusinessLogic
 
 LOGGER = logging.getLogger(__name__)
 
+# seconds the kernel may cache attributes and names
+DEFAULT_ATTR_TIMEOUT = 5
+DEFAULT_ENTRY_TIMEOUT = 5
+# default of both for a snapshot mount
+READ_ONLY_TIMEOUT = 300
+
 class Operations(llfuse.Operations):
     """
     contains request handlers used by llfuse
     """
 
     @calltrace_logger
-    def __init__(self, library, mountpoint, current_view_name):
+    def __init__(self, library, mountpoint, current_view_name, snapshot=False,
+                 attr_timeout=DEFAULT_ATTR_TIMEOUT, entry_timeout=DEFAULT_ENTRY_TIMEOUT,
+                 stat_cache_ttl=DEFAULT_STAT_CACHE_TTL, stat_cache_size=DEFAULT_STAT_CACHE_SIZE):
         """
-        set basic config
+        set basic config.
+        With snapshot, the library is served read-only from memory.
+        attr_timeout and entry_timeout are passed to the kernel,
+        the stat-infos of the source files are cached for stat_cache_ttl seconds.
         """
         super().__init__()
         self.mountpoint = mountpoint
         # we need to get that one here, since accessing anything sth. inside the libfs
         # will deadlock
         self.mountpoint_parent = os.path.dirname(mountpoint)
-        self.business_logic = BusinessLogic(library, None, current_view_name)
+        self.business_logic = BusinessLogic(library, None, current_view_name, snapshot=snapshot)
+        self.read_only = snapshot
         self.cache = Memcache()
-        self.business_logic.generate_vtree()
+        self.listing_cache = ListingCache()
+        self.stat_cache = StatCache(stat_cache_size, stat_cache_ttl)
+        self.attr_timeout = attr_timeout
+        self.entry_timeout = entry_timeout
+        # open directories: handle -> listing when it was opened
+        self.dir_handles = {}
+        self.next_dir_handle = 1
         self._pinode_fn2srcpath_map = {}
         self.vdir_stat = llfuse.EntryAttributes()
-        self.lib_stat = os.lstat(library)
+        # strip the options for the database
+        self.lib_stat = os.lstat(library.split("?", 1)[0])
         # set times
         # mtime from mounting
         self.vdir_stat.st_atime_ns = int(mktime(localtime()) * 10**9)
@@ -44,8 +70,8 @@ class Operations(llfuse.Operations):
         self.vdir_stat.st_mtime_ns = self.lib_stat.st_mtime_ns
         # other standard-entries
         self.vdir_stat.generation = 0
-        self.vdir_stat.attr_timeout = 5
-        self.vdir_stat.entry_timeout = 5
+        self.vdir_stat.attr_timeout = self.attr_timeout
+        self.vdir_stat.entry_timeout = self.entry_timeout
         self.vdir_stat.st_blksize = 512
         self.vdir_stat.st_blocks = 666
         self.vdir_stat.st_gid = os.getgid()
@@ -106,10 +132,12 @@ class Operations(llfuse.Operations):
         # we're dealing with a file here
         try:
             if file_desc is None:
-                src_path = self.business_logic.get_srcfilename_by_srcinode(inode)
-                this_stat = os.lstat(src_path)
+                with llfuse.lock_released:
+                    src_path = self.business_logic.get_srcfilename_by_srcinode(inode)
+                this_stat = self._stat_src(src_path)
             else:
-                this_stat = os.fstat(file_desc)
+                with llfuse.lock_released:
+                    this_stat = os.fstat(file_desc)
         except OSError as exc:
             raise FUSEError(exc.errno)
         return self._fill_attr_entry(this_stat)
@@ -133,8 +161,18 @@ class Operations(llfuse.Operations):
         return attribute from a src file
         """
         assert not src_path.startswith(self.mountpoint)
-        this_stat = os.lstat(src_path)
-        return self._fill_attr_entry(this_stat)
+        return self._fill_attr_entry(self._stat_src(src_path))
+
+    def _stat_src(self, src_path):
+        """
+        return the stat-info of a src file, from the stat-cache if possible
+        """
+        this_stat = self.stat_cache.get(src_path)
+        if this_stat is None:
+            with llfuse.lock_released:
+                this_stat = os.lstat(src_path)
+            self.stat_cache.put(src_path, this_stat)
+        return this_stat
 
     def _fill_attr_entry(self, stat):
         """
@@ -147,8 +185,8 @@ class Operations(llfuse.Operations):
                      'st_ctime_ns'):
             setattr(entry, attr, getattr(stat, attr))
         entry.generation = 0
-        entry.entry_timeout = 5
-        entry.attr_timeout = 5
+        entry.entry_timeout = self.entry_timeout
+        entry.attr_timeout = self.attr_timeout
         entry.st_blksize = 512
         entry.st_blocks = ((entry.st_size + entry.st_blksize-1) // entry.st_blksize)
         LOGGER.debug("_fill_attr_entry: returning inode from fs: %s", entry.st_ino)
@@ -157,12 +195,16 @@ class Operations(llfuse.Operations):
     @calltrace_logger
     def opendir(self, inode, ctx):
         """
-        open a dir, return the inode-number as a fh
+        open a dir, return a handle to the listing of its entries.
+        The listing stays the same until the handle is released.
         """
         LOGGER.debug('opendir %s', inode)
         if not self.business_logic.is_vdir(self.cache.get_path_by_inode(inode)):
             raise FUSEError(errno.ENOTDIR)
-        return inode
+        dir_handle = self.next_dir_handle
+        self.next_dir_handle += 1
+        self.dir_handles[dir_handle] = self._readdir(inode)
+        return dir_handle
 
     @calltrace_logger
     def _readdir(self, inode):
@@ -172,9 +214,35 @@ class Operations(llfuse.Operations):
         """
         vpath = self.cache.get_path_by_inode(inode)
         LOGGER.debug('readdir %s', vpath)
-        # XXX
-        # check cache first !
+        if self.business_logic.has_changed():
+            LOGGER.debug('readdir: library changed, dropping all listings')
+            self.business_logic.generate_vtree()
+            self.listing_cache.clear()
+        entries = self.listing_cache.get(vpath)
+        if entries is not None:
+            self._add_entries_to_cache(vpath, entries)
+            return entries
+        while True:
+            generation = self.listing_cache.generation
+            entries, src_paths = self._read_listing(vpath)
+            # another worker may have renamed something, while the lock was released
+            if self.listing_cache.put(vpath, entries, generation):
+                break
+            LOGGER.debug('readdir: listings invalidated while reading %s, reading again', vpath)
+        try:
+            self._pinode_fn2srcpath_map[inode].update(src_paths)
+        except KeyError:
+            self._pinode_fn2srcpath_map[inode] = src_paths
+        self._add_entries_to_cache(vpath, entries)
+        return entries
+
+    def _read_listing(self, vpath):
+        """
+        return the entries of a directory from the db and
+        a dict of the source paths of its files by name
+        """
         entries = []
+        src_paths = {}
         # get files from db for this vdir
         for vnode, vname, src_path in self.business_logic.get_contents_by_vpath(vpath):
             if src_path is None:
@@ -193,32 +261,40 @@ class Operations(llfuse.Operations):
                 else:
                     attr = self._get_src_attr(src_path)
                 entries.append((vnode, vname, attr))
-                try:
-                    self._pinode_fn2srcpath_map[inode][vname] = src_path
-                except:
-                    self._pinode_fn2srcpath_map[inode] = {vname: src_path}
+                src_paths[vname] = src_path
+        return entries, src_paths
+
+    def _add_entries_to_cache(self, vpath, entries):
+        """
+        remember the paths of the entries of a directory
+        """
         for entry in entries:
             if entry[1] == "." or entry[1] == "..": continue
             this_path = os.path.join(vpath, entry[1])
             self.cache.add_inode_path_pair(entry[0], this_path)
-        return entries
 
     @calltrace_logger
-    def readdir(self, inode, off):
+    def readdir(self, dir_handle, off):
         """
-        read dir-entries. inode should be a file-handle, but
-        we just use the inode-number for now
+        read dir-entries from the listing of a handle returned by opendir.
+        off is the position in the listing to continue from.
         """
-        entries = self._readdir(inode)
-        LOGGER.debug('readdir entries: %s', entries)
+        try:
+            entries = self.dir_handles[dir_handle]
+        except KeyError:
+            raise FUSEError(errno.EBADF)
         LOGGER.debug('readdir read %d entries, starting at %d', len(entries), off)
-        LOGGER.debug('inode2vpath_map: %s', self.cache.inode2vpath_map)
-        LOGGER.debug('_pinode_fn2srcpath_map: %s', self._pinode_fn2srcpath_map)
 
-        for (ino, name, attr) in sorted(entries):
-            if ino <= off:
-                continue
-            yield (fsencode(name), attr, ino)
+        for pos in range(off, len(entries)):
+            (ino, name, attr) = entries[pos]
+            yield (fsencode(name), attr, pos + 1)
+
+    @calltrace_logger
+    def releasedir(self, dir_handle):
+        """
+        free the listing of a handle returned by opendir
+        """
+        self.dir_handles.pop(dir_handle, None)
 
     @calltrace_logger
     def rename(self, old_parent_inode, old_name, new_parent_inode, new_name, ctx):
@@ -227,6 +303,8 @@ class Operations(llfuse.Operations):
         It changes the metadata of the file
         and updates the db respectively.
         """
+        if self.read_only:
+            raise FUSEError(errno.EROFS)
         old_name = fsdecode(old_name)
         new_name = fsdecode(new_name)
         old_parent = self.cache.get_path_by_inode(old_parent_inode)
@@ -266,6 +344,10 @@ class Operations(llfuse.Operations):
             self.business_logic.generate_vtree()
             self.cache.update_maps(old_path, new_path)
             self.cache.lookup_lock.release()
+            self.listing_cache.invalidate(old_parent)
+            self.listing_cache.invalidate(new_parent)
+            self.listing_cache.invalidate(old_path, below=True)
+            self.listing_cache.invalidate(new_path, below=True)
         else: # rename a single file
             # get source path of file in question
             src_path = self._pinode_fn2srcpath_map[old_parent_inode][old_name]
@@ -304,15 +386,22 @@ class Operations(llfuse.Operations):
                 else:
                     raise FUSEError(errno.EINVAL)
             # then update in-memory cache
+            self.stat_cache.invalidate(src_path)
             self.cache.lookup_lock.acquire()
 
+            # the file is not parsed again, keep the metadata which did not change
+            entry = self.business_logic.get_entry(src_path) or {}
+            entry.update(new_metadata)
             self.business_logic.remove_entry(src_path)
-            self.business_logic.add_entry(src_path, new_metadata)
+            self.business_logic.add_entry(src_path, entry)
             inode = self.business_logic.get_inode_by_srcfilename(src_path)
             self.cache.update_inode_path_pair(inode, new_path)
             self._pinode_fn2srcpath_map[old_parent_inode][new_name] = src_path
             del self._pinode_fn2srcpath_map[old_parent_inode][old_name]
             self.cache.lookup_lock.release()
+            # the name and the duplicate counters of its neighbours may have changed
+            self.listing_cache.invalidate(old_parent)
+            self.listing_cache.invalidate(new_parent)
 
             # tell kernel to forget about this file, we changed its metadata
             llfuse.invalidate_inode(inode)
@@ -323,6 +412,8 @@ class Operations(llfuse.Operations):
         """
         a new directory means a new "." entry in the list of the present dirtree.
         """
+        if self.read_only:
+            raise FUSEError(errno.EROFS)
         full_path = os.path.join(self.cache.get_path_by_inode(parent_inode), fsdecode(name))
         if not self.business_logic.is_vdir(full_path):
             raise FUSEError(errno.ENOLINK)
@@ -331,6 +422,7 @@ class Operations(llfuse.Operations):
         if vnode < 0:
             raise FUSEError(-vnode)
         self.cache.add_inode_path_pair(vnode, full_path)
+        self.listing_cache.invalidate(os.path.dirname(full_path))
         vattr = self._get_vdir_attr(full_path)
         return vattr
 
@@ -339,11 +431,15 @@ class Operations(llfuse.Operations):
         """
         remove an empty dir
         """
+        if self.read_only:
+            raise FUSEError(errno.EROFS)
         full_path = os.path.join(self.cache.get_path_by_inode(parent_inode), fsdecode(name))
         if not self.business_logic.is_vdir(full_path):
             raise FUSEError(errno.ENOLINK)
         self.business_logic.rmdir(full_path)
         self.cache.forget_path(parent_inode, name)
+        self.listing_cache.invalidate(os.path.dirname(full_path))
+        self.listing_cache.invalidate(full_path)
         return
 
     @calltrace_logger
@@ -360,10 +456,11 @@ class Operations(llfuse.Operations):
         if flags & os.O_CREAT:
             raise FUSEError(errno.EROFS)
         try:
-            file_desc = os.open(self.business_logic.get_srcfilename_by_srcinode(inode), flags)
+            with llfuse.lock_released:
+                src_path = self.business_logic.get_srcfilename_by_srcinode(inode)
+                file_desc = os.open(src_path, flags)
         except OSError as exc:
-            LOGGER.error("Cannot open %s with flags %s",
-                         self.business_logic.get_srcfilename_by_srcinode(inode), flags)
+            LOGGER.error("Cannot open inode %s with flags %s: %s", inode, flags, exc)
             raise FUSEError(exc.errno)
         self.cache.inode2fd_map[inode] = file_desc
         self.cache.fd2inode_map[file_desc] = inode
@@ -373,10 +470,12 @@ class Operations(llfuse.Operations):
     @calltrace_logger
     def read(self, file_desc, offset, length):
         """
-        read from a file descriptor
+        read from a file descriptor.
+        The descriptor may be shared by several readers, so use pread
+        instead of seeking.
         """
-        os.lseek(file_desc, offset, os.SEEK_SET)
-        return os.read(file_desc, length)
+        with llfuse.lock_released:
+            return os.pread(file_desc, length, offset)
 
     @calltrace_logger
     def release(self, file_desc):
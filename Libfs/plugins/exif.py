@@ -4,6 +4,7 @@ The metadata itself is always a dict.
 """
 
 import os
+import struct
 import time
 
 import piexif
@@ -19,21 +20,84 @@ VIRT_TIME_KEYS = ['Year', 'Month', 'Day', 'Hour', 'Minute', 'Second']
 #VIRT_GEO_KEYS = ['latitude', 'longitude', 'state', 'state_long', 'country', 'country_long',
 # 'city', 'street', 'street_long', 'housenumber']
 
+# tag-number -> name for each IFD, computed once
+TAG_NAMES = {ifd: {tag: piexif.TAGS[ifd][tag]["name"] for tag in piexif.TAGS[ifd]}
+             for ifd in piexif.TAGS}
+
+# NOTE: Some keys exist more than once.
+# Some keys do not exist and have to be assembled to be put back again.
+VALID_KEYS = frozenset(list(TAG_NAMES['Image'].values()) + list(TAG_NAMES['Exif'].values()) +
+                       #list(TAG_NAMES['GPS'].values()) +
+                       VIRT_TIME_KEYS)
+
+# JPEG markers
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+JPEG_SOS = b"\xff\xda"
+JPEG_APP1 = b"\xff\xe1"
+EXIF_HEADER = b"Exif\x00\x00"
+
+def read_exif_segment(src_filename):
+    """
+    read only the leading segments of a JPEG up to the EXIF block.
+    Returns a minimal JPEG (SOI, APP1, SOS) to be parsed by piexif,
+    or None if the file is no JPEG or its segment layout is unusual.
+    """
+    with open(src_filename, "rb") as src_file:
+        if src_file.read(2) != JPEG_SOI:
+            return None
+        while True:
+            marker = src_file.read(2)
+            if len(marker) != 2 or marker[0] != 0xff:
+                return None
+            if marker in (JPEG_SOS, JPEG_EOI):
+                # image data starts, there is no EXIF block
+                return JPEG_SOI + JPEG_SOS
+            length_bytes = src_file.read(2)
+            if len(length_bytes) != 2:
+                return None
+            length = struct.unpack(">H", length_bytes)[0]
+            if length < 2:
+                return None
+            if marker == JPEG_APP1:
+                payload = src_file.read(length - 2)
+                if len(payload) != length - 2:
+                    return None
+                # APP1 may also contain XMP
+                if payload.startswith(EXIF_HEADER):
+                    return JPEG_SOI + marker + length_bytes + payload + JPEG_SOS
+                continue
+            src_file.seek(length - 2, os.SEEK_CUR)
+
+def load_exif(src_filename):
+    """
+    return the exif_dict of a file.
+    For JPEGs only the header is read, the whole file only
+    if the header cannot be parsed by read_exif_segment.
+    """
+    exif_segment = read_exif_segment(src_filename)
+    if exif_segment is None:
+        return piexif.load(src_filename)
+    return piexif.load(exif_segment)
+
 @calltrace_logger
 def read_metadata(src_filename):
     """
     read the metadata from a sourcefile
     """
     metadata = {}
-    exif_dict = piexif.load(src_filename)
+    exif_dict = load_exif(src_filename)
     for ifd in ("0th", "1st", "Image", "Exif", "GPS"):
         if not ifd in exif_dict: continue
-        for tag in exif_dict[ifd]:
+        tag_names = TAG_NAMES[ifd]
+        for tag, value in exif_dict[ifd].items():
+            name = tag_names.get(tag)
+            if name is None: continue
             # make everything simple a string
-            if isinstance(exif_dict[ifd][tag], bytes):
-                metadata[piexif.TAGS[ifd][tag]["name"]] = "%s" % (exif_dict[ifd][tag].decode(),)
+            if isinstance(value, bytes):
+                metadata[name] = "%s" % (value.decode(),)
             else:
-                metadata[piexif.TAGS[ifd][tag]["name"]] = "%s" % (exif_dict[ifd][tag],)
+                metadata[name] = "%s" % (value,)
 
     # get Datetime Tag
     LOGGER.debug("read_metadata: %s", metadata)
@@ -92,11 +156,13 @@ def write_metadata(src_filename, metadata):
     metadata["DateTime"] = bytes(metadata["DateTime"].encode())
     for ifd in ("0th", "1st", "Image", "Exif", "GPS", "Interop"):
         if not ifd in exif_dict.keys(): continue
+        tag_names = TAG_NAMES[ifd]
         for tag in exif_dict[ifd]:
-            LOGGER.debug("checking %s", piexif.TAGS[ifd][tag]["name"])
-            if not piexif.TAGS[ifd][tag]["name"] in metadata.keys(): continue
-            exif_dict[ifd][tag] = metadata[piexif.TAGS[ifd][tag]["name"]]
-            LOGGER.debug("relacing %s with %s", piexif.TAGS[ifd][tag]["name"], metadata[piexif.TAGS[ifd][tag]["name"]])
+            name = tag_names.get(tag)
+            LOGGER.debug("checking %s", name)
+            if not name in metadata: continue
+            exif_dict[ifd][tag] = metadata[name]
+            LOGGER.debug("relacing %s with %s", name, metadata[name])
     LOGGER.debug("exif_dict: %s", exif_dict)
     exif_bytes = piexif.dump(exif_dict)
     piexif.remove(src_filename)
@@ -108,7 +174,7 @@ def is_valid_metadata(key, value):
     """
     check if the given key/value pair makes sense
     """
-    if not key in get_valid_keys():
+    if not key in VALID_KEYS:
         return False
     if key == "Year":
         try:
@@ -130,16 +196,5 @@ def get_default_view():
 def get_valid_keys():
     """
     return a list of all valid keys for this plugin
-    NOTE: Some keys exist more than once.
-    Some keys do not exist and have to be assembled to be put back again.
     """
-
-    valid_keys = [piexif.TAGS['Image'][tag]['name'] for tag in piexif.TAGS['Image']]
-    valid_keys += [piexif.TAGS['Exif'][tag]['name'] for tag in piexif.TAGS['Exif']]
-    #valid_keys += [piexif.TAGS['GPS'][tag]['name'] for tag in piexif.TAGS['GPS']]
-    # Not existing in EXIF
-    valid_keys += VIRT_TIME_KEYS
-    #valid_keys += VIRT_GEO_KEYS
-    # remove duplicates
-    valid_keys = list(set(valid_keys))
-    return valid_keys
+    return sorted(VALID_KEYS)
@@ -12,6 +12,13 @@ LOGGER = logging.getLogger(__name__)
 
 IGNORE_KEYS = []
 
+# valid_keys may contain characters confusing the shell
+# could write an escape-mechnism for them (:* )
+VALID_KEYS = tuple(k for k in sorted(EasyID3.valid_keys.keys())
+                   if not ":" in k and not "*" in k and not " " in k and not k in IGNORE_KEYS)
+VALID_KEY_SET = frozenset(VALID_KEYS)
+GENRE_SET = frozenset(GENRES)
+
 @calltrace_logger
 def read_metadata(src_filename):
     """
@@ -41,8 +48,10 @@ def is_valid_metadata(key, value):
     e.g. Tracknumber must be an integer
     Ignore it for now
     """
+    if not key in VALID_KEY_SET:
+        return False
     if key == "genre":
-        return value in GENRES
+        return value in GENRE_SET
     elif key == "tracknumber":
         try:
             if value == int(value):
@@ -65,13 +74,4 @@ def get_valid_keys():
     """
     return a list of all valid keys for this plugin
     """
-    valid_keys = []
-    # valid_keys may contain characters confusing the shell
-    # could write an escape-mechnism for them (:* )
-    for k in sorted(EasyID3.valid_keys.keys()):
-        if ":" in k: continue
-        if "*" in k: continue
-        if " " in k: continue
-        if k in IGNORE_KEYS: continue
-        valid_keys.append(k)
-    return valid_keys
+    return list(VALID_KEYS)
@@ -0,0 +1,99 @@
+"""
+scanner for source directories
+
+Walks a directory tree with os.scandir and streams the files found,
+together with their stat-info, so that it doesn't have to be
+fetched again when the entries are put into the database.
+"""
+
+import logging
+import os
+
+from fnmatch import fnmatch
+
+LOGGER = logging.getLogger(__name__)
+
+def matches_any(name, rel_path, patterns):
+    """
+    check if the name or the path relative to the scanned root
+    matches any of the given glob-patterns
+    """
+    for pattern in patterns:
+        if fnmatch(name, pattern) or fnmatch(rel_path, pattern):
+            return True
+    return False
+
+def scan_tree(root, include=None, exclude=None, max_depth=None, skip_dirs=None, dir_done=None,
+              start_dirs=None, dir_skipped=None):
+    """
+    generator returning tuples (src_filename, src_statinfo)
+    for all files under root.
+    include and exclude are lists of glob-patterns. Files must match
+    one of the include patterns, if given. Files and directories
+    matching an exclude pattern are skipped.
+    max_depth limits the number of directory levels below root
+    to descend into, None means unlimited.
+    Symlinks to directories are not followed.
+    The files directly in a directory of skip_dirs are not returned,
+    but its subdirectories are still scanned.
+    dir_done is called with the path of every directory, after all
+    of its files have been returned.
+    With start_dirs, only these directories below root are scanned.
+    Their depth and the patterns are still relative to root.
+    dir_skipped is called with the path of every directory, whose files
+    are not returned although it exists, because it cannot be read
+    or is below max_depth.
+    """
+    root = os.path.abspath(root)
+    include = include or []
+    exclude = exclude or []
+    skip_dirs = skip_dirs or set()
+    # directories still to be scanned, as (path, depth)
+    stack = []
+    for dir_path in start_dirs or [root]:
+        dir_path = os.path.abspath(dir_path)
+        rel_dir = os.path.relpath(dir_path, root)
+        if rel_dir == os.curdir:
+            stack.append((dir_path, 0))
+        else:
+            stack.append((dir_path, rel_dir.count(os.sep) + 1))
+    while stack:
+        dir_path, depth = stack.pop()
+        try:
+            dir_iter = os.scandir(dir_path)
+        except (FileNotFoundError, NotADirectoryError) as excep:
+            LOGGER.warning("cannot scan directory: %s. Exception=%s", dir_path, excep)
+            continue
+        except OSError as excep:
+            LOGGER.warning("cannot scan directory: %s. Exception=%s", dir_path, excep)
+            if dir_skipped is not None:
+                dir_skipped(dir_path)
+            continue
+        rel_dir = os.path.relpath(dir_path, root)
+        skip_files = dir_path in skip_dirs
+        with dir_iter:
+            for entry in dir_iter:
+                if rel_dir == os.curdir:
+                    rel_path = entry.name
+                else:
+                    rel_path = os.path.join(rel_dir, entry.name)
+                if exclude and matches_any(entry.name, rel_path, exclude):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if max_depth is None or depth < max_depth:
+                            stack.append((entry.path, depth + 1))
+                        elif dir_skipped is not None:
+                            dir_skipped(entry.path)
+                        continue
+                    if skip_files or not entry.is_file():
+                        continue
+                    if include and not matches_any(entry.name, rel_path, include):
+                        continue
+                    src_statinfo = entry.stat()
+                except OSError as excep:
+                    LOGGER.warning("cannot stat file: %s. Exception=%s", entry.path, excep)
+                    continue
+                yield entry.path, src_statinfo
+        if dir_done is not None:
+            dir_done(dir_path)
@@ -0,0 +1,54 @@
+"""
+in-memory snapshot of a library for read-only mounts
+
+The trees of the current view are read once, when the library
+is mounted. Afterwards lookups and listings are served from
+dicts without querying the database.
+"""
+
+import logging
+import sys
+
+LOGGER = logging.getLogger(__name__)
+
+class Snapshot:
+    """
+    the files of a library, indexed for the current view
+    """
+
+    def __init__(self, business_logic):
+        """
+        load the snapshot from the db of business_logic
+        """
+        # vdir -> list of (src_inode, name, src_filename) in the order of the db
+        self.leaves = {}
+        self.src_by_inode = {}
+        self.inode_by_src = {}
+        res = business_logic.DB_BE.iter_query("SELECT vdir, %s, gen_name, dup, %s FROM %s "\
+                                              "WHERE view=? ORDER BY rowid;" %
+                                              (business_logic.SRC_INODE_KEY,
+                                               business_logic.SRC_FILENAME_KEY,
+                                               business_logic.VTREE_TABLE),
+                                              business_logic.current_view_name)
+        for vdir, src_inode, gen_name, dup, src_filename in res:
+            if dup > 0:
+                gen_name = business_logic.DUPLICATE_NAME % (gen_name, dup)
+            # many files share a directory, keep only one copy of its name
+            vdir = sys.intern(vdir)
+            self.leaves.setdefault(vdir, []).append((src_inode, gen_name, src_filename))
+            self.src_by_inode[src_inode] = src_filename
+            self.inode_by_src[src_filename] = src_inode
+        LOGGER.debug("Snapshot: loaded %d files in %d directories",
+                     len(self.src_by_inode), len(self.leaves))
+
+    def get_vdirs(self):
+        """
+        return the tuples of dirtree-values of all leaf directories
+        """
+        return [tuple(vdir.split("/")) for vdir in self.leaves]
+
+    def get_leaf(self, vpath_list):
+        """
+        return the list of (src_inode, name, src_filename) in a leaf directory
+        """
+        return self.leaves.get("/".join(vpath_list), [])
@@ -1,15 +1,62 @@
 """"
 DB-backend for sqlite3
-XXX this is not thread-safe !?
+
+All writes go through a single connection, serialized by a lock.
+Queries from other threads than the one which opened the database
+are run on a read-only connection of their own, so that e.g. the
+workers of a mount can read concurrently.
 """
 
 import logging
 import sqlite3
 import sys
+import threading
+from urllib.request import pathname2url
 from Libfs.misc import calltrace_logger
 
 LOGGER = logging.getLogger(__name__)
 
+# number of compiled statements kept per connection.
+# Queries are built once with parameters, so the same
+# statement-strings are executed over and over again.
+STATEMENT_CACHE_SIZE = 256
+# number of rows fetched at once by iter_query
+DEFAULT_ARRAYSIZE = 1000
+
+# allowed tuning options in the connection string and
+# a check of their values, since PRAGMAs cannot take parameters
+def _is_int(value):
+    """
+    check if value is an integer
+    """
+    try:
+        int(value)
+    except ValueError:
+        return False
+    return True
+
+TUNING_OPTIONS = {
+    "journal_mode": lambda v: v.upper() in ["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL",
+                                            "OFF"],
+    "synchronous": lambda v: v.upper() in ["OFF", "NORMAL", "FULL", "EXTRA", "0", "1", "2", "3"],
+    "temp_store": lambda v: v.upper() in ["DEFAULT", "FILE", "MEMORY", "0", "1", "2"],
+    "mmap_size": _is_int,
+    "cache_size": _is_int,
+}
+
+# default tuning for the two workloads.
+# WAL lets a mount read while an update is writing.
+PROFILES = {
+    # bulk writes by update and watch
+    "update": {"journal_mode": "WAL", "synchronous": "NORMAL", "temp_store": "MEMORY",
+               "mmap_size": "268435456", "cache_size": "-65536"},
+    # read-mostly by mount
+    "mount": {"journal_mode": "WAL", "synchronous": "NORMAL", "temp_store": "MEMORY",
+              "mmap_size": "1073741824", "cache_size": "-32768"},
+    # one large read when a snapshot is loaded
+    "snapshot": {"temp_store": "MEMORY", "mmap_size": "1073741824", "cache_size": "-65536"},
+}
+
 
 class db_backend:
     """
@@ -28,43 +75,196 @@ class db_backend:
         """
         self.connection = None
         self.cursor = None
+        self.db_path = None
+        self.read_only = False
+        self.tuning = {}
+        # serializes the use of the writing connection
+        self.write_lock = threading.RLock()
+        self.writer_thread = None
+        # per-thread reading connections
+        self.local = threading.local()
 
     @calltrace_logger
-    def open(self, user, host, passwd, db_path):
+    def open(self, user, host, passwd, db_path, options=None, profile=None, read_only=False):
         """
-        opens a connection and creates a cursor
+        opens a connection and creates a cursor.
+        The tuning options of the profile are applied first,
+        then the given options.
+        A read_only database must exist and its journal_mode is left as it is.
         """
+        tuning = dict(PROFILES.get(profile, {}))
+        for key, value in (options or {}).items():
+            if not key in TUNING_OPTIONS:
+                sys.stderr.write("Unknown option %s for database %s\n" % (key, db_path))
+                sys.exit(1)
+            if not TUNING_OPTIONS[key](value):
+                sys.stderr.write("Invalid value %s for option %s\n" % (value, key))
+                sys.exit(1)
+            tuning[key] = value
+        if read_only:
+            tuning.pop("journal_mode", None)
+        self.db_path = db_path
+        self.read_only = read_only
+        self.tuning = tuning
         try:
-            self.connection = sqlite3.connect(db_path)
+            self.connection = self.connect(check_same_thread=False)
+            self.cursor = self.connection.cursor()
+            for key, value in tuning.items():
+                LOGGER.debug("open: PRAGMA %s=%s", key, value)
+                self.cursor.execute("PRAGMA %s=%s" % (key, value))
         except sqlite3.OperationalError:
             sys.stderr.write("unable to open database file %s\n" % db_path)
             sys.exit(1)
-        self.cursor = self.connection.cursor()
+        self.writer_thread = threading.get_ident()
         return
 
+    def connect(self, check_same_thread=True):
+        """
+        return a new connection to the database
+        """
+        if self.read_only:
+            return sqlite3.connect("file:%s?mode=ro" % pathname2url(self.db_path), uri=True,
+                                   cached_statements=STATEMENT_CACHE_SIZE,
+                                   check_same_thread=check_same_thread)
+        return sqlite3.connect(self.db_path, cached_statements=STATEMENT_CACHE_SIZE,
+                               check_same_thread=check_same_thread)
+
+    def get_reader(self):
+        """
+        return the read-only connection of the current thread,
+        open it if required.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            LOGGER.debug("get_reader: opening connection for thread %s", threading.get_ident())
+            connection = self.connect()
+            for key, value in self.tuning.items():
+                # the journal_mode is a property of the database file
+                if key == "journal_mode":
+                    continue
+                connection.execute("PRAGMA %s=%s" % (key, value))
+            connection.execute("PRAGMA query_only=ON")
+            self.local.connection = connection
+        return connection
+
+    @calltrace_logger
+    def execute_query(self, query_str, *args):
+        """
+        log and execute a read-only statement.
+        Within the thread which opened the db, this is the same as execute_statment,
+        so that uncommitted changes are visible. Other threads use their own connection.
+        """
+        if threading.get_ident() == self.writer_thread:
+            return self.execute_statment(query_str, *args)
+        LOGGER.debug("Executing query %s, %s", query_str, args)
+        return self.get_reader().execute(query_str, args).fetchall()
+
+    @calltrace_logger
+    def iter_query(self, query_str, *args, arraysize=DEFAULT_ARRAYSIZE, writer=False):
+        """
+        log and execute a read-only statement, return an iterator over the
+        resulting rows, which are fetched arraysize at a time.
+        Uses a cursor of its own, so that other statements can be
+        executed while iterating.
+        With writer, the writing connection is used in any thread, so that
+        the uncommitted changes of the current transaction are visible.
+        """
+        LOGGER.debug("Executing iterated query %s, %s", query_str, args)
+        if writer or threading.get_ident() == self.writer_thread:
+            lock = self.write_lock
+            connection = self.connection
+        else:
+            lock = None
+            connection = self.get_reader()
+        cursor = connection.cursor()
+        cursor.arraysize = arraysize
+        try:
+            if lock is None:
+                cursor.execute(query_str, args)
+            else:
+                with lock:
+                    cursor.execute(query_str, args)
+            while True:
+                if lock is None:
+                    rows = cursor.fetchmany()
+                else:
+                    with lock:
+                        rows = cursor.fetchmany()
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
     @calltrace_logger
     def execute_statment(self, query_str, *args):
         """
         log and execute a statement
         """
         LOGGER.debug("Executing %s, %s", query_str, args)
-        self.cursor.execute(query_str, args)
-        return self.cursor.fetchall()
+        with self.write_lock:
+            self.cursor.execute(query_str, args)
+            return self.cursor.fetchall()
+
+    @calltrace_logger
+    def execute_many(self, query_str, args_list):
+        """
+        log and execute a statement once for every tuple of arguments
+        """
+        LOGGER.debug("Executing many %s", query_str)
+        with self.write_lock:
+            self.cursor.executemany(query_str, args_list)
+            return self.cursor.rowcount
+
+    def transaction(self):
+        """
+        return a context manager, which keeps the other threads from
+        using the writing connection until a transaction is committed
+        """
+        return self.write_lock
+
+    def get_data_version(self):
+        """
+        return a number, which changes whenever another connection
+        has committed changes to the database
+        """
+        with self.write_lock:
+            self.cursor.execute("PRAGMA data_version")
+            return self.cursor.fetchone()[0]
 
     @calltrace_logger
     def get_columns(self, table):
         """
         return list of a columns (or fields) of a table
         """
-        self.cursor.execute("PRAGMA table_info('%s')" % table)
-        return [tpl[1] for tpl in self.cursor.fetchall()]
+        with self.write_lock:
+            self.cursor.execute("PRAGMA table_info(%s)" % table)
+            return [tpl[1] for tpl in self.cursor.fetchall()]
+
+    @calltrace_logger
+    def get_unique_columns(self, table):
+        """
+        return the set of columns of a table, which are unique on their own
+        """
+        columns = set()
+        with self.write_lock:
+            self.cursor.execute("PRAGMA index_list(%s)" % table)
+            unique_indexes = [tpl[1] for tpl in self.cursor.fetchall() if tpl[2]]
+            for index in unique_indexes:
+                self.cursor.execute("PRAGMA index_info('%s')" % index)
+                index_columns = self.cursor.fetchall()
+                if len(index_columns) == 1:
+                    columns.add(index_columns[0][2])
+        return columns
 
     @calltrace_logger
     def commit(self):
         """
         return a transaction
         """
-        self.connection.commit()
+        with self.write_lock:
+            self.connection.commit()
 
     def __repr__(self):
         """
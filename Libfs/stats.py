@@ -0,0 +1,88 @@
+"""
+statistics about an update run, can be written out as json
+"""
+
+import heapq
+import json
+import os
+import time
+
+from collections import defaultdict
+
+# upper bounds in milliseconds of the latency-histogram buckets,
+# the last bucket takes everything above
+HISTOGRAM_BOUNDS_MS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096]
+# number of slowest files to report
+SLOWEST_FILES = 20
+
+class UpdateStats:
+    """
+    collects counters and timings of an update
+    """
+
+    def __init__(self, slowest_files=SLOWEST_FILES):
+        """
+        start the clock
+        """
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.slowest_files = slowest_files
+        self.counts = {"scanned": 0, "inserted": 0, "updated": 0, "skipped": 0,
+                       "errors": 0, "obsolete": 0}
+        # seconds spent in each phase
+        self.times = {"scan": 0.0, "read_metadata": 0.0, "db_write": 0.0}
+        # extension -> list of counts per bucket
+        self.histograms = defaultdict(lambda: [0] * (len(HISTOGRAM_BOUNDS_MS) + 1))
+        # min-heap of (duration, src_filename)
+        self.slowest = []
+
+    def add_read_time(self, src_filename, duration):
+        """
+        account the time read_metadata took for a file
+        """
+        self.times["read_metadata"] += duration
+        duration_ms = duration * 1000
+        bucket = len(HISTOGRAM_BOUNDS_MS)
+        for i, bound in enumerate(HISTOGRAM_BOUNDS_MS):
+            if duration_ms < bound:
+                bucket = i
+                break
+        ext = os.path.splitext(src_filename)[1].lower()
+        self.histograms[ext][bucket] += 1
+        if len(self.slowest) < self.slowest_files:
+            heapq.heappush(self.slowest, (duration, src_filename))
+        elif duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (duration, src_filename))
+
+    def stop(self):
+        """
+        stop the clock
+        """
+        self.end_time = time.monotonic()
+
+    def to_dict(self):
+        """
+        return the statistics as a dict
+        """
+        end_time = self.end_time or time.monotonic()
+        elapsed = end_time - self.start_time
+        labels = ["<%dms" % bound for bound in HISTOGRAM_BOUNDS_MS]
+        labels.append(">=%dms" % HISTOGRAM_BOUNDS_MS[-1])
+        return {
+            "elapsed": elapsed,
+            "files_per_second": self.counts["scanned"] / elapsed if elapsed > 0 else 0.0,
+            "counts": dict(self.counts),
+            # read_metadata is summed up over all worker processes
+            "times": dict(self.times),
+            "latency_histograms": {ext: dict(zip(labels, buckets))
+                                   for ext, buckets in self.histograms.items()},
+            "slowest_files": [{"src_filename": src_filename, "seconds": duration}
+                              for duration, src_filename in sorted(self.slowest, reverse=True)],
+        }
+
+    def write_json(self, path):
+        """
+        write the statistics as json into a file
+        """
+        with open(path, "w") as json_file:
+            json.dump(self.to_dict(), json_file, indent=2)
@@ -0,0 +1,277 @@
+"""
+update a library from a source directory
+
+The metadata of the source files is extracted by the plugin,
+optionally in a pool of worker processes.
+The results are streamed back to the calling process, which is the
+only one writing to the database.
+"""
+
+import logging
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from importlib import import_module
+
+from Libfs.misc import calltrace_logger
+from Libfs.scanner import scan_tree
+from Libfs.stats import UpdateStats
+
+LOGGER = logging.getLogger(__name__)
+
+# number of files per worker which are submitted to the pool in advance.
+# Keeps the workers busy without reading the whole tree into memory.
+QUEUE_DEPTH_PER_JOB = 16
+
+# plugins already imported in this process, by name
+_PLUGINS = {}
+
+def get_plugin(plugin_name):
+    """
+    return the plugin module, import it only once per process
+    """
+    try:
+        return _PLUGINS[plugin_name]
+    except KeyError:
+        _PLUGINS[plugin_name] = import_module("Libfs.plugins.%s" % plugin_name)
+        return _PLUGINS[plugin_name]
+
+def read_metadata(plugin_name, src_filename):
+    """
+    read the metadata of a single file.
+    Runs inside the worker processes, so it must not raise:
+    returns a tuple (metadata, error, duration),
+    one of metadata and error is None.
+    """
+    start = time.monotonic()
+    try:
+        metadata = get_plugin(plugin_name).read_metadata(src_filename)
+    except Exception as excep:
+        return None, "%s" % (excep,), time.monotonic() - start
+    return metadata, None, time.monotonic() - start
+
+def iter_metadata(plugin_name, src_entries, jobs=1):
+    """
+    generator returning tuples (src_filename, src_statinfo, metadata, error, duration)
+    for all given tuples (src_filename, src_statinfo).
+    With jobs > 1, the files are parsed in a pool of processes
+    and the results are returned in the order they are finished.
+    If a worker process dies, the files in flight are returned as errors
+    and the pool is restarted for the remaining files.
+    """
+    if jobs <= 1:
+        for src_filename, src_statinfo in src_entries:
+            metadata, error, duration = read_metadata(plugin_name, src_filename)
+            yield src_filename, src_statinfo, metadata, error, duration
+        return
+
+    src_entries = iter(src_entries)
+    executor = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        pending = {}
+        exhausted = False
+        while True:
+            # keep the queue filled
+            while not exhausted and len(pending) < jobs * QUEUE_DEPTH_PER_JOB:
+                try:
+                    src_filename, src_statinfo = next(src_entries)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = executor.submit(read_metadata, plugin_name, src_filename)
+                pending[future] = (src_filename, src_statinfo)
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            broken = False
+            while done:
+                for future in done:
+                    src_filename, src_statinfo = pending.pop(future)
+                    try:
+                        metadata, error, duration = future.result()
+                    except BrokenProcessPool as excep:
+                        # a worker died, e.g. in a crashing decoder or by the OOM-killer.
+                        # It is unknown which of the files in flight caused it.
+                        metadata, error, duration = None, "worker process died: %s" % excep, 0.0
+                        broken = True
+                    yield src_filename, src_statinfo, metadata, error, duration
+                # the files still in flight are lost together with the pool
+                done = wait(pending)[0] if broken else set()
+            if broken:
+                LOGGER.warning("iter_metadata: a worker process died, restarting the pool")
+                executor.shutdown()
+                executor = ProcessPoolExecutor(max_workers=jobs)
+    finally:
+        executor.shutdown()
+
+@calltrace_logger
+def update_library(business_logic, plugin_name, source, jobs=1, remove_obsolete=False,
+                   full_rescan=False, include=None, exclude=None, max_depth=None,
+                   obsolete_dry_run=False, resume=False, directories=None):
+    """
+    scan source and put the metadata of all files into the library.
+    Files which did not change since the last update are skipped,
+    unless full_rescan is set.
+    include, exclude and max_depth are passed on to the scanner.
+    With remove_obsolete, entries below source which were not found by
+    the scan are removed afterwards, or only counted with obsolete_dry_run.
+    The entries below directories which could not be scanned are kept.
+    The directories whose files are all written are checkpointed in the db,
+    with resume the files in the directories of an interrupted update
+    are skipped.
+    With directories, only these directories below source are scanned
+    in a single pass, e.g. by watch, and no checkpoints are used.
+    Returns an UpdateStats object.
+    """
+    if resume and remove_obsolete:
+        raise RuntimeError("update_library: resume cannot be combined with remove_obsolete.")
+    if max_depth is not None and remove_obsolete:
+        raise RuntimeError("update_library: max_depth cannot be combined with remove_obsolete.")
+    if resume and directories is not None:
+        raise RuntimeError("update_library: resume cannot be combined with directories.")
+    stats = UpdateStats()
+    source = os.path.abspath(source)
+    use_checkpoints = directories is None
+    if directories is None:
+        directories = [source]
+        # libraries created before the views had indexes
+        business_logic.sync_view_indexes()
+    else:
+        directories = [os.path.abspath(d) for d in directories]
+    if resume:
+        done_dirs = business_logic.get_checkpoints(source)
+        LOGGER.info("update: resuming, skipping %d completed directories", len(done_dirs))
+    else:
+        if use_checkpoints:
+            business_logic.clear_checkpoints(source)
+        done_dirs = set()
+    # number of files per directory not yet handed to the db-layer
+    outstanding = {}
+    # directories completely scanned, but with outstanding files
+    scanned_dirs = set()
+    seen = []
+    # existing directories whose files have not been scanned
+    unscanned = []
+    # time spent outside of the db-layer while it is writing
+    producer_time = [0.0]
+    if remove_obsolete:
+        business_logic.start_scan()
+
+    def dir_scanned(dir_path):
+        """
+        called by the scanner after the last file of dir_path
+        """
+        if outstanding.get(dir_path, 0) == 0:
+            outstanding.pop(dir_path, None)
+            if use_checkpoints:
+                business_logic.add_checkpoint(source, dir_path)
+        else:
+            scanned_dirs.add(dir_path)
+
+    def dir_skipped(dir_path):
+        """
+        called by the scanner for an existing directory it could not read
+        """
+        unscanned.append(dir_path)
+
+    def file_done(src_filename):
+        """
+        called after a file has been handed to the db-layer or failed
+        """
+        dir_path = os.path.dirname(src_filename)
+        outstanding[dir_path] -= 1
+        if outstanding[dir_path] == 0 and dir_path in scanned_dirs:
+            scanned_dirs.remove(dir_path)
+            dir_scanned(dir_path)
+
+    def walk_source():
+        """
+        return the absolute paths and stat-info of all
+        new or changed files under source
+        """
+        resumed = time.monotonic()
+        # the scanner returns the files of a directory one after the other,
+        # so only the recorded stat-info of the current directory is kept
+        known_dir = None
+        known_stats = {}
+        for src_filename, src_statinfo in scan_tree(source, include, exclude, max_depth,
+                                                    done_dirs, dir_scanned, directories,
+                                                    dir_skipped):
+            stats.counts["scanned"] += 1
+            if remove_obsolete:
+                seen.append(src_filename)
+                if len(seen) >= business_logic.BATCH_SIZE:
+                    business_logic.mark_seen(seen)
+                    del seen[:]
+            dir_path = os.path.dirname(src_filename)
+            if not full_rescan and dir_path != known_dir:
+                known_dir = dir_path
+                known_stats = business_logic.get_src_stats(dir_path)
+            if known_stats.get(src_filename) == (src_statinfo.st_size,
+                                                 src_statinfo.st_mtime_ns,
+                                                 src_statinfo.st_ino):
+                stats.counts["skipped"] += 1
+                continue
+            stats.times["scan"] += time.monotonic() - resumed
+            outstanding[dir_path] = outstanding.get(dir_path, 0) + 1
+            yield src_filename, src_statinfo
+            resumed = time.monotonic()
+        stats.times["scan"] += time.monotonic() - resumed
+
+    def parsed_entries():
+        """
+        return the files the plugin could read
+        """
+        resumed = time.monotonic()
+        for src_filename, src_statinfo, metadata, error, duration in \
+                iter_metadata(plugin_name, walk_source(), jobs):
+            stats.add_read_time(src_filename, duration)
+            if error is not None:
+                LOGGER.warning("cannot read metadata of file: %s. Exception=%s",
+                               src_filename, error)
+                stats.counts["errors"] += 1
+                file_done(src_filename)
+                continue
+            producer_time[0] += time.monotonic() - resumed
+            yield src_filename, metadata, src_statinfo
+            # the entry is in the current batch of add_entries now
+            file_done(src_filename)
+            resumed = time.monotonic()
+        producer_time[0] += time.monotonic() - resumed
+
+    start = time.monotonic()
+    inserted, updated = business_logic.add_entries(parsed_entries())
+    stats.times["db_write"] += time.monotonic() - start - producer_time[0]
+    stats.counts["inserted"] = inserted
+    stats.counts["updated"] = updated
+    # finished, no need to resume
+    if use_checkpoints:
+        business_logic.clear_checkpoints(source)
+    LOGGER.info("update: %d entries inserted, %d updated, %d unchanged",
+                inserted, updated, stats.counts["skipped"])
+
+    # remove obsolete entries, if desired
+    # useful for updating
+    if remove_obsolete:
+        start = time.monotonic()
+        business_logic.mark_seen(seen)
+        # e.g. a share which is temporarily not available
+        for dir_path in unscanned:
+            business_logic.mark_seen_below(dir_path)
+        if unscanned:
+            LOGGER.warning("update: keeping the entries below %d directories, "\
+                           "which could not be scanned", len(unscanned))
+        obsolete = 0
+        for dir_path in directories:
+            obsolete += business_logic.remove_unseen(dir_path, obsolete_dry_run)
+        stats.times["db_write"] += time.monotonic() - start
+        stats.counts["obsolete"] = obsolete
+        if obsolete_dry_run:
+            sys.stdout.write("%d obsolete entries would be removed.\n" % obsolete)
+        else:
+            LOGGER.info("update: %d obsolete entries removed", obsolete)
+    stats.stop()
+    return stats
@@ -0,0 +1,284 @@
+"""
+keep a library up to date by following the changes in its source
+directory with inotify.
+
+The events are collected until nothing happened for a short time
+and then written to the library in batches.
+"""
+
+import logging
+import os
+import select
+import stat
+import time
+
+from Libfs.inotify import Inotify, IN_CREATE, IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_FROM, \
+    IN_MOVED_TO, IN_DELETE, IN_ONLYDIR, IN_DONT_FOLLOW, IN_ISDIR, IN_IGNORED, IN_Q_OVERFLOW
+from Libfs.misc import calltrace_logger
+from Libfs.scanner import matches_any
+from Libfs.update import iter_metadata, update_library
+
+LOGGER = logging.getLogger(__name__)
+
+WATCH_MASK = IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE |\
+             IN_ONLYDIR | IN_DONT_FOLLOW
+
+# seconds without events before the pending changes are written
+DEFAULT_DEBOUNCE = 2.0
+# write the pending changes at the latest after debounce * MAX_DELAY_FACTOR,
+# even if the events do not stop
+MAX_DELAY_FACTOR = 10
+
+def is_below(path, directories):
+    """
+    check if path is below one of directories
+    """
+    for directory in directories:
+        if path.startswith(os.path.join(directory, "")):
+            return True
+    return False
+
+class LibraryWatcher:
+    """
+    follows the changes under a source directory and
+    applies them to the library
+    """
+
+    def __init__(self, business_logic, plugin_name, source, include=None, exclude=None,
+                 debounce=DEFAULT_DEBOUNCE):
+        """
+        set basic config
+        """
+        self.business_logic = business_logic
+        self.plugin_name = plugin_name
+        self.source = os.path.abspath(source)
+        self.include = include or []
+        self.exclude = exclude or []
+        self.debounce = debounce
+        self.inotify = Inotify()
+        self.wd2dir = {}
+        self.dir2wd = {}
+        # changes not yet written to the library
+        self.pending_files = set()
+        self.pending_dirs = set()
+        self.rescan = False
+        self.first_event = None
+        self.last_event = None
+
+    def is_excluded(self, path, is_dir=False):
+        """
+        check if path is excluded from the library by the include and exclude patterns
+        """
+        name = os.path.basename(path)
+        rel_path = os.path.relpath(path, self.source)
+        if self.exclude and matches_any(name, rel_path, self.exclude):
+            return True
+        if not is_dir and self.include and not matches_any(name, rel_path, self.include):
+            return True
+        return False
+
+    @calltrace_logger
+    def watch_tree(self, directory):
+        """
+        add watches for directory and all directories below,
+        which are not watched yet
+        """
+        stack = [directory]
+        while stack:
+            dir_path = stack.pop()
+            if dir_path != self.source and self.is_excluded(dir_path, is_dir=True):
+                continue
+            if not dir_path in self.dir2wd:
+                try:
+                    wd = self.inotify.add_watch(dir_path, WATCH_MASK)
+                except OSError as excep:
+                    LOGGER.warning("cannot watch directory: %s. Exception=%s", dir_path, excep)
+                    continue
+                self.wd2dir[wd] = dir_path
+                self.dir2wd[dir_path] = wd
+            try:
+                with os.scandir(dir_path) as dir_iter:
+                    for entry in dir_iter:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+            except OSError as excep:
+                LOGGER.warning("cannot scan directory: %s. Exception=%s", dir_path, excep)
+        return
+
+    @calltrace_logger
+    def unwatch_tree(self, directory):
+        """
+        remove the watches of directory and all directories below
+        """
+        prefix = os.path.join(directory, "")
+        for dir_path in [d for d in self.dir2wd if d == directory or d.startswith(prefix)]:
+            wd = self.dir2wd.pop(dir_path)
+            del self.wd2dir[wd]
+            self.inotify.rm_watch(wd)
+        return
+
+    def handle_event(self, wd, mask, cookie, name):
+        """
+        remember what has to be updated because of an event
+        """
+        if mask & IN_Q_OVERFLOW:
+            LOGGER.warning("inotify queue overflow, rescanning %s", self.source)
+            self.rescan = True
+            return
+        if mask & IN_IGNORED:
+            dir_path = self.wd2dir.pop(wd, None)
+            if dir_path is not None:
+                self.dir2wd.pop(dir_path, None)
+            return
+        directory = self.wd2dir.get(wd)
+        if directory is None:
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.unwatch_tree(path)
+            self.pending_dirs.add(path)
+        else:
+            self.pending_files.add(path)
+        return
+
+    def has_pending(self):
+        """
+        check if there are changes not yet written
+        """
+        return self.rescan or len(self.pending_files) > 0 or len(self.pending_dirs) > 0
+
+    def get_timeout(self):
+        """
+        return how long to wait for further events,
+        None if there is nothing to write.
+        """
+        if not self.has_pending():
+            return None
+        now = time.monotonic()
+        deadline = min(self.last_event + self.debounce,
+                       self.first_event + self.debounce * MAX_DELAY_FACTOR)
+        return max(0, deadline - now)
+
+    @calltrace_logger
+    def flush(self):
+        """
+        write all pending changes into the library
+        """
+        if self.rescan:
+            # directories may have been created while the events were dropped
+            self.watch_tree(self.source)
+            update_library(self.business_logic, self.plugin_name, self.source,
+                           remove_obsolete=True, include=self.include, exclude=self.exclude)
+            self.pending_files = set()
+            self.pending_dirs = set()
+            self.rescan = False
+
+        # the subdirectories are handled together with the topmost directory
+        to_scan = []
+        to_remove_below = []
+        for dir_path in sorted(self.pending_dirs):
+            if is_below(dir_path, to_scan + to_remove_below):
+                continue
+            if self.is_excluded(dir_path, is_dir=True) or not os.path.isdir(dir_path):
+                to_remove_below.append(dir_path)
+            else:
+                to_scan.append(dir_path)
+        for dir_path in to_remove_below:
+            self.business_logic.remove_entries_below(dir_path)
+        if to_scan:
+            # created or moved here, remove what is gone from the library
+            update_library(self.business_logic, self.plugin_name, self.source,
+                           remove_obsolete=True, include=self.include, exclude=self.exclude,
+                           directories=to_scan)
+
+        to_add = []
+        to_remove = []
+        excluded = []
+        for src_filename in self.pending_files:
+            if is_below(src_filename, to_scan + to_remove_below):
+                continue
+            if self.is_excluded(src_filename):
+                excluded.append(src_filename)
+                continue
+            try:
+                src_statinfo = os.stat(src_filename)
+            except OSError:
+                to_remove.append(src_filename)
+                continue
+            if stat.S_ISREG(src_statinfo.st_mode):
+                to_add.append((src_filename, src_statinfo))
+            else:
+                to_remove.append(src_filename)
+        # e.g. renamed to an excluded name
+        to_remove.extend(self.business_logic.get_existing_src_names(excluded))
+
+        def parsed_entries():
+            """
+            return the files the plugin could read
+            """
+            for src_filename, src_statinfo, metadata, error, _ in iter_metadata(self.plugin_name,
+                                                                                to_add):
+                if error is not None:
+                    LOGGER.warning("cannot read metadata of file: %s. Exception=%s",
+                                   src_filename, error)
+                    continue
+                yield src_filename, metadata, src_statinfo
+
+        if to_remove:
+            self.business_logic.remove_entries(to_remove)
+        inserted, updated = self.business_logic.add_entries(parsed_entries())
+        LOGGER.info("watch: %d entries inserted, %d updated, %d removed",
+                    inserted, updated, len(to_remove))
+        self.pending_files = set()
+        self.pending_dirs = set()
+        self.first_event = self.last_event = None
+        return
+
+    def run(self):
+        """
+        wait for events and write them in batches into the library.
+        Blocks without a timeout as long as nothing changes.
+        """
+        while True:
+            readable, _, _ = select.select([self.inotify], [], [], self.get_timeout())
+            if readable:
+                for event in self.inotify.read_events():
+                    self.handle_event(*event)
+                # events like IN_IGNORED leave nothing to write
+                if self.has_pending():
+                    now = time.monotonic()
+                    if self.first_event is None:
+                        self.first_event = now
+                    self.last_event = now
+            if self.has_pending() and self.get_timeout() == 0:
+                self.flush()
+
+    def close(self):
+        """
+        write what is pending and stop watching
+        """
+        if self.has_pending():
+            self.flush()
+        self.inotify.close()
+
+@calltrace_logger
+def watch_library(business_logic, plugin_name, source, jobs=1, include=None, exclude=None,
+                  debounce=DEFAULT_DEBOUNCE):
+    """
+    bring the library up to date and keep it so until interrupted
+    """
+    watcher = LibraryWatcher(business_logic, plugin_name, source, include, exclude, debounce)
+    # watch first, so that no change during the initial update gets lost
+    watcher.watch_tree(watcher.source)
+    update_library(business_logic, plugin_name, source, jobs=jobs, remove_obsolete=True,
+                   include=include, exclude=exclude)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return
@@ -20,12 +20,16 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE."""
 from argparse import ArgumentParser
 import llfuse
 import logging
-import os
+import sys
 import yaml
 
 from Libfs.misc import get_available_plugins
 from Libfs.business_logic import BusinessLogic
-from Libfs.operations import Operations
+from Libfs.cache import DEFAULT_STAT_CACHE_SIZE, DEFAULT_STAT_CACHE_TTL
+from Libfs.operations import Operations, DEFAULT_ATTR_TIMEOUT, DEFAULT_ENTRY_TIMEOUT, \
+    READ_ONLY_TIMEOUT
+from Libfs.update import update_library
+from Libfs.watch import watch_library, DEFAULT_DEBOUNCE
 import faulthandler
 
 faulthandler.enable()
@@ -40,15 +44,36 @@ def main():
     subparsers = parser.add_subparsers(dest='subparser_name', help='sub-command help')
     parser_mount = subparsers.add_parser('mount', help='mount a libfs')
     parser_update = subparsers.add_parser('update', help='update a library')
+    parser_watch = subparsers.add_parser('watch', help='keep a library up to date')
+    parser_migrate = subparsers.add_parser('migrate',
+                                           help='convert a library to the compact layout')
     #
     # options for mount subcommand
     #
     parser_mount.add_argument('library', type=str,
-                              help='Library file for the views')
+                              help='Library file for the views. Options for sqlite can be '\
+                                   'appended like lib.db?journal_mode=WAL&cache_size=-65536')
     parser_mount.add_argument('--debug_fuse', action='store_true',
                               help='debug fuse')
     parser_mount.add_argument('mountpoint', type=str,
                               help='Where to mount the file system')
+    parser_mount.add_argument('--workers', type=int, default=1,
+                              help='number of threads serving requests')
+    parser_mount.add_argument('--snapshot', action='store_true',
+                              help='mount read-only and serve the view from memory')
+    parser_mount.add_argument('--attr_timeout', type=float,
+                              help='seconds the kernel caches attributes, default %s, '\
+                                   'with --snapshot %s' % (DEFAULT_ATTR_TIMEOUT,
+                                                           READ_ONLY_TIMEOUT))
+    parser_mount.add_argument('--entry_timeout', type=float,
+                              help='seconds the kernel caches names, default %s, '\
+                                   'with --snapshot %s' % (DEFAULT_ENTRY_TIMEOUT,
+                                                           READ_ONLY_TIMEOUT))
+    parser_mount.add_argument('--stat_cache_ttl', type=float, default=DEFAULT_STAT_CACHE_TTL,
+                              help='seconds the stat-info of a source file is cached')
+    parser_mount.add_argument('--stat_cache_size', type=int, default=DEFAULT_STAT_CACHE_SIZE,
+                              help='number of source files whose stat-info is cached, '\
+                                   '0 disables the cache')
     #
     # options for update subcommand
     #
@@ -56,12 +81,63 @@ def main():
     parser_update.add_argument('source', type=str,
                                help='Data directory to scan')
     parser_update.add_argument('library', type=str,
-                               help='Library file for the views')
+                               help='Library file for the views. Options for sqlite can be '\
+                                    'appended like lib.db?journal_mode=WAL&cache_size=-65536')
     parser_update.add_argument("--type", type=str, required=True,
                                choices=get_available_plugins(),
                                help="type of library fos scanning.")
     parser_update.add_argument("--remove_obsolete", action='store_true',
                                help="remove entries from db which are not found under source")
+    parser_update.add_argument("--obsolete_dry_run", action='store_true',
+                               help="with --remove_obsolete, only count the obsolete entries. "\
+                                    "New and changed files are still written.")
+    parser_update.add_argument("--jobs", type=int, default=1,
+                               help="number of processes reading the metadata in parallel")
+    parser_update.add_argument("--full_rescan", action='store_true',
+                               help="read the metadata of all files, even if they did not change")
+    parser_update.add_argument("--include", type=str, action='append',
+                               help="only scan files matching this glob-pattern. "\
+                                    "Can be given multiple times.")
+    parser_update.add_argument("--exclude", type=str, action='append',
+                               help="skip files and directories matching this glob-pattern. "\
+                                    "Can be given multiple times.")
+    parser_update.add_argument("--max_depth", type=int,
+                               help="maximum number of directory levels to descend into")
+    parser_update.add_argument("--resume", action='store_true',
+                               help="continue an interrupted update, skipping the directories "\
+                                    "it has completed")
+    parser_update.add_argument("--stats_json", type=str,
+                               help="write statistics about throughput and latencies "\
+                                    "as json into this file")
+    #
+    # options for watch subcommand
+    #
+
+    parser_watch.add_argument('source', type=str,
+                              help='Data directory to watch')
+    parser_watch.add_argument('library', type=str,
+                              help='Library file for the views. Options for sqlite can be '\
+                                   'appended like lib.db?journal_mode=WAL&cache_size=-65536')
+    parser_watch.add_argument("--type", type=str, required=True,
+                              choices=get_available_plugins(),
+                              help="type of library fos scanning.")
+    parser_watch.add_argument("--jobs", type=int, default=1,
+                              help="number of processes reading the metadata in parallel "\
+                                   "during the initial update")
+    parser_watch.add_argument("--include", type=str, action='append',
+                              help="only watch files matching this glob-pattern. "\
+                                   "Can be given multiple times.")
+    parser_watch.add_argument("--exclude", type=str, action='append',
+                              help="ignore files and directories matching this glob-pattern. "\
+                                   "Can be given multiple times.")
+    parser_watch.add_argument("--debounce", type=float, default=DEFAULT_DEBOUNCE,
+                              help="seconds without changes before they are written "\
+                                   "into the library")
+    #
+    # options for migrate subcommand
+    #
+    parser_migrate.add_argument('library', type=str,
+                                help='Library file to convert')
     #
     # common options
     #
@@ -88,45 +164,76 @@ def main():
         fuse_options.add('default_permissions')
         if options.debug_fuse:
             fuse_options.add('debug')
-
-        operations = Operations(options.library, options.mountpoint, options.view)
+        if options.snapshot:
+            fuse_options.add('ro')
+
+        # a snapshot does not change, so the kernel may keep its view much longer
+        if options.attr_timeout is None:
+            options.attr_timeout = READ_ONLY_TIMEOUT if options.snapshot else DEFAULT_ATTR_TIMEOUT
+        if options.entry_timeout is None:
+            options.entry_timeout = READ_ONLY_TIMEOUT if options.snapshot \
+                                    else DEFAULT_ENTRY_TIMEOUT
+        operations = Operations(options.library, options.mountpoint, options.view,
+                                snapshot=options.snapshot, attr_timeout=options.attr_timeout,
+                                entry_timeout=options.entry_timeout,
+                                stat_cache_ttl=options.stat_cache_ttl,
+                                stat_cache_size=options.stat_cache_size)
         llfuse.init(operations, options.mountpoint, fuse_options)
         try:
             LOGGER.debug('Entering main loop..')
-            llfuse.main(workers=1)
+            llfuse.main(workers=options.workers)
         except:
             llfuse.close(unmount=False)
             raise
         LOGGER.debug('Umounting..')
         llfuse.close()
-    elif options.subparser_name == 'update':
+    elif options.subparser_name in ['update', 'watch']:
 
     #
     # update library
     #
         from importlib import import_module
 
+        if options.jobs < 1:
+            parser.error("--jobs must be at least 1")
+        if options.subparser_name == 'update' and options.resume and options.remove_obsolete:
+            parser.error("--resume cannot be combined with --remove_obsolete")
+        if options.subparser_name == 'update' and options.max_depth is not None and \
+           options.remove_obsolete:
+            parser.error("--max_depth cannot be combined with --remove_obsolete")
+        if options.subparser_name == 'update' and options.obsolete_dry_run and \
+           not options.remove_obsolete:
+            parser.error("--obsolete_dry_run requires --remove_obsolete")
         plugin = import_module("Libfs.plugins.%s" % options.type)
         magix = {}
         magix["valid_keys"] = plugin.get_valid_keys()
         magix["default_view"] = plugin.get_default_view()
         magix["plugin"] = options.type
-        bl = BusinessLogic(options.library, magix=magix)
-        for root, dirs, files in os.walk(options.source):
-            for f in files:
-                full_path = os.path.abspath("%s/%s" % (root, f))
-                try:
-                    metadata = plugin.read_metadata(full_path)
-                except Exception as excep:
-                    LOGGER.warning("cannot read metadata of file: %s. Exception=%s", full_path, excep)
-                    continue
-                bl.add_entry(full_path, metadata)
-        # remove obsolete entries, if desired
-        # useful for updating
-        if options.remove_obsolete:
-            for src_name in bl.get_all_src_names():
-                if not os.path.exists(src_name):
-                    bl.remove_entry(src_name)
+        bl = BusinessLogic(options.library, magix=magix, db_profile="update")
+        if options.subparser_name == 'watch':
+            try:
+                watch_library(bl, options.type, options.source, jobs=options.jobs,
+                              include=options.include, exclude=options.exclude,
+                              debounce=options.debounce)
+            except OSError as excep:
+                sys.stderr.write("Cannot watch %s: %s\n" % (options.source, excep))
+                sys.exit(1)
+            return
+        stats = update_library(bl, options.type, options.source, jobs=options.jobs,
+                               remove_obsolete=options.remove_obsolete,
+                               full_rescan=options.full_rescan, include=options.include,
+                               exclude=options.exclude, max_depth=options.max_depth,
+                               obsolete_dry_run=options.obsolete_dry_run, resume=options.resume)
+        if options.stats_json:
+            stats.write_json(options.stats_json)
+    elif options.subparser_name == 'migrate':
+        # the trees of an old library are built from the converted table
+        bl = BusinessLogic(options.library, db_profile="update", build_trees=False)
+        num_rows = bl.migrate_files_table()
+        if num_rows is None:
+            sys.stdout.write("Library %s is already compact.\n" % options.library)
+        else:
+            sys.stdout.write("Converted %d entries of library %s.\n" % (num_rows, options.library))
     else:    # should never arrive here
         parser.error("No command given")
 
@@ -7,7 +7,7 @@ to mount a libfs under testmnt/ with a copy of testdata/test.db as db
 import unittest
 
 from test.test_id3 import ID3Test
-from test.test_exif import EXIFTest
+from test.test_exif import EXIFTest, EXIFWorkersTest, EXIFSnapshotTest, EXIFLoadTest
 
 if __name__ == "__main__":
     unittest.main()
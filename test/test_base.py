@@ -1,10 +1,21 @@
+import errno
+import json
 import os
 import platform
+import re
 import shutil
+import sqlite3
 import subprocess
+import tempfile
 import time
 import unittest
 
+from unittest import mock
+
+from Libfs.business_logic import BusinessLogic
+from Libfs.update import update_library
+from Libfs.watch import LibraryWatcher
+
 
 class TestBase(unittest.TestCase):
     """
@@ -14,6 +25,8 @@ class TestBase(unittest.TestCase):
     LIBFS_BIN = "scripts/libfs.py"
     LIBFS_MNT = "./test/mnt"
     LIBFS_LOG_CFG = "./test/logging.cfg"
+    # additional options of the mount command
+    MOUNT_OPTIONS = []
 
     TYPE = "N/A"
     LIBFS_SRC_DIR = "N/A"
@@ -35,17 +48,11 @@ class TestBase(unittest.TestCase):
         except OSError:
             pass
 
-        cmd_list = [cls.LIBFS_BIN, "--logconf", cls.LIBFS_LOG_CFG, "update", "--type",
-                               cls.TYPE, cls.LIBFS_SRC_DIR, cls.LIBFS_DB]
-        with subprocess.Popen(cmd_list, stderr=subprocess.PIPE, stdout=subprocess.PIPE) as create_db_proc:
-            output, outerr = create_db_proc.communicate()
-            if create_db_proc.poll():
-                raise RuntimeError("Create DB command \"%s\" failed with rc=%s. output=%s, outerr=%s" %\
-                                   (" ".join(cmd_list), create_db_proc.poll(), output, outerr))
+        cls.run_update()
 
         # mount libfs
-        cmd_list = [cls.LIBFS_BIN, "--logconf", cls.LIBFS_LOG_CFG, "mount",
-                    cls.LIBFS_DB, cls.LIBFS_MNT]
+        cmd_list = [cls.LIBFS_BIN, "--logconf", cls.LIBFS_LOG_CFG, "mount"] + \
+                   cls.MOUNT_OPTIONS + [cls.LIBFS_DB, cls.LIBFS_MNT]
         cls.mount_proc = subprocess.Popen(cmd_list, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
         # check if mount worked
         time.sleep(0.5)
@@ -55,6 +62,41 @@ class TestBase(unittest.TestCase):
             raise RuntimeError("Mount command \"%s\" failed with rc=%s. output=%s, outerr=%s" %\
                                (" ".join(cmd_list), cls.mount_proc.poll(), output, outerr))
 
+    @classmethod
+    def run_update(cls, *extra_args, source=None):
+        """
+        (re-)create the database by scanning the source directory,
+        LIBFS_SRC_DIR by default. Returns the output.
+        """
+        if source is None:
+            source = cls.LIBFS_SRC_DIR
+        cmd_list = [cls.LIBFS_BIN, "--logconf", cls.LIBFS_LOG_CFG, "update", "--type",
+                    cls.TYPE] + list(extra_args) + [source, cls.LIBFS_DB]
+        with subprocess.Popen(cmd_list, stderr=subprocess.PIPE, stdout=subprocess.PIPE) as create_db_proc:
+            output, outerr = create_db_proc.communicate()
+            if create_db_proc.poll():
+                raise RuntimeError("Create DB command \"%s\" failed with rc=%s. output=%s, outerr=%s" %\
+                                   (" ".join(cmd_list), create_db_proc.poll(), output, outerr))
+        return output.decode()
+
+    def make_source(self, num_copies):
+        """
+        create a temporary source directory with copies of EXISTING_FILE,
+        which all end up in EXISTING_DIR
+        """
+        source = tempfile.mkdtemp()
+        ext = os.path.splitext(self.EXISTING_FILE)[1]
+        for i in range(num_copies):
+            shutil.copyfile(self.EXISTING_FILE, os.path.join(source, "copy%d%s" % (i, ext)))
+        return source
+
+    def remove_source(self, source):
+        """
+        remove a temporary source directory and its entries in the db
+        """
+        shutil.rmtree(source)
+        self.run_update("--remove_obsolete", source=source)
+
     @classmethod
     def tearDownClass(cls):
         """
@@ -104,6 +146,18 @@ class TestBase(unittest.TestCase):
         shutil.move(self.EXISTING_DIR, self.NON_EXISTING_DIR)
         shutil.move(self.NON_EXISTING_DIR, self.EXISTING_DIR)
 
+    def test_dir_mv_listing(self):
+        """
+        Move a dir, its files must be listed under the new name.
+        """
+        before = sorted(os.listdir(self.EXISTING_DIR))
+        shutil.move(self.EXISTING_DIR, self.NON_EXISTING_DIR)
+        try:
+            self.assertEqual(sorted(os.listdir(self.NON_EXISTING_DIR)), before)
+        finally:
+            shutil.move(self.NON_EXISTING_DIR, self.EXISTING_DIR)
+        self.assertEqual(sorted(os.listdir(self.EXISTING_DIR)), before)
+
     def test_mkdir_rmdir(self):
         """
         create a dir.
@@ -111,3 +165,401 @@ class TestBase(unittest.TestCase):
         os.mkdir(self.NON_EXISTING_DIR)
         os.rmdir(self.NON_EXISTING_DIR)
 
+    def list_tree(self):
+        """
+        return the sorted paths of everything in the mounted tree
+        """
+        paths = []
+        for root, dirs, files in os.walk(self.LIBFS_MNT):
+            paths.extend([os.path.join(root, name) for name in dirs + files])
+        return sorted(paths)
+
+    def update_counts(self, *extra_args, source=None):
+        """
+        run an update and return its counts
+        """
+        fd, stats_json = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            self.run_update("--stats_json", stats_json, *extra_args, source=source)
+            with open(stats_json) as json_file:
+                return json.load(json_file)["counts"]
+        finally:
+            os.unlink(stats_json)
+
+    def get_entries(self):
+        """
+        return the entries of all files in the library, by src_filename
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            db = os.path.join(tmp_dir, "copy.db")
+            self.copy_db(db)
+            business_logic = BusinessLogic(db)
+            return {src_name: business_logic.get_entry(src_name)
+                    for src_name in business_logic.get_all_src_names()}
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_update_jobs(self):
+        """
+        read all files again, parsing them in parallel.
+        The tree must stay the same.
+        """
+        before = self.list_tree()
+        counts = self.update_counts("--full_rescan", "--jobs", "2")
+        self.assertEqual(counts["skipped"], 0)
+        self.assertGreater(counts["updated"], 0)
+        self.assertEqual(counts["updated"] + counts["errors"], counts["scanned"])
+        self.assertEqual(self.list_tree(), before)
+        self.assertTrue(os.path.exists(self.EXISTING_FILE))
+
+    def test_update_unchanged(self):
+        """
+        unchanged files are skipped, touched files are read again
+        """
+        source = self.make_source(2)
+        try:
+            counts = self.update_counts(source=source)
+            self.assertEqual(counts["inserted"], 2)
+            counts = self.update_counts(source=source)
+            self.assertEqual(counts["skipped"], 2)
+            self.assertEqual(counts["inserted"] + counts["updated"], 0)
+            src_filename = os.path.join(source, sorted(os.listdir(source))[0])
+            stat_info = os.stat(src_filename)
+            os.utime(src_filename, ns=(stat_info.st_atime_ns, stat_info.st_mtime_ns + 10**9))
+            counts = self.update_counts(source=source)
+            self.assertEqual(counts["skipped"], 1)
+            self.assertEqual(counts["updated"], 1)
+        finally:
+            self.remove_source(source)
+
+    def test_file_mv_entry(self):
+        """
+        rename a file and back, its entry must keep all of its metadata
+        and is not read again by the next update.
+        """
+        before = self.get_entries()
+        shutil.move(self.EXISTING_FILE, self.NON_EXISTING_FILE)
+        shutil.move(self.NON_EXISTING_FILE, self.EXISTING_FILE)
+        after = self.get_entries()
+        self.assertEqual({src_name: sorted(entry) for src_name, entry in after.items()},
+                         {src_name: sorted(entry) for src_name, entry in before.items()})
+        counts = self.update_counts()
+        self.assertEqual(counts["skipped"] + counts["errors"], counts["scanned"])
+
+    def test_remove_obsolete(self):
+        """
+        remove only the entries below the scanned source,
+        which have not been found.
+        """
+        before = os.listdir(self.EXISTING_DIR)
+        source = self.make_source(2)
+        try:
+            self.run_update(source=source)
+            self.assertEqual(len(os.listdir(self.EXISTING_DIR)), len(before) + 2)
+            os.unlink(os.path.join(source, os.listdir(source)[0]))
+            output = self.run_update("--remove_obsolete", "--obsolete_dry_run", source=source)
+            self.assertIn("1 obsolete entries would be removed.", output)
+            self.assertEqual(len(os.listdir(self.EXISTING_DIR)), len(before) + 2)
+            self.run_update("--remove_obsolete", source=source)
+            self.assertEqual(len(os.listdir(self.EXISTING_DIR)), len(before) + 1)
+        finally:
+            self.remove_source(source)
+        self.assertEqual(sorted(os.listdir(self.EXISTING_DIR)), sorted(before))
+
+    def test_readdir_chunks(self):
+        """
+        list a directory with more entries than fit into one reply to the kernel,
+        so that readdir has to continue from an offset.
+        Every entry must be listed exactly once.
+        """
+        before = os.listdir(self.EXISTING_DIR)
+        num_copies = 500
+        source = self.make_source(num_copies)
+        try:
+            self.run_update(source=source)
+            # stop reading after the first entry, the handle is released anyway
+            with os.scandir(self.EXISTING_DIR) as entries:
+                next(entries)
+            for i in range(2):
+                names = os.listdir(self.EXISTING_DIR)
+                self.assertEqual(len(names), len(before) + num_copies)
+                self.assertEqual(len(set(names)), len(names))
+        finally:
+            self.remove_source(source)
+        self.assertEqual(sorted(os.listdir(self.EXISTING_DIR)), sorted(before))
+
+    def test_remove_obsolete_max_depth(self):
+        """
+        files below max_depth are not found, so they cannot be told apart
+        from obsolete ones.
+        """
+        with self.assertRaises(RuntimeError):
+            self.run_update("--remove_obsolete", "--max_depth", "1")
+
+    def test_remove_obsolete_unreadable(self):
+        """
+        keep the entries below a directory, which cannot be scanned,
+        e.g. on a share which is temporarily not available.
+        """
+        source = self.make_source(2)
+        sub_dir = os.path.join(source, "sub")
+        os.mkdir(sub_dir)
+        sub_file = os.path.join(sub_dir, os.path.basename(self.EXISTING_FILE))
+        shutil.copyfile(self.EXISTING_FILE, sub_file)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            db = os.path.join(tmp_dir, "copy.db")
+            self.copy_db(db)
+            business_logic = BusinessLogic(db)
+            update_library(business_logic, self.TYPE, source)
+            src_names = [src_name for src_name in business_logic.get_all_src_names()
+                         if src_name.startswith(source)]
+            self.assertEqual(len(src_names), 3)
+            obsolete_file = os.path.join(source, sorted(os.listdir(source))[0])
+            os.unlink(obsolete_file)
+            scandir = os.scandir
+
+            def failing_scandir(path):
+                """
+                fail on sub_dir only
+                """
+                if path == sub_dir:
+                    raise OSError(errno.EIO, os.strerror(errno.EIO), path)
+                return scandir(path)
+
+            with mock.patch("Libfs.scanner.os.scandir", failing_scandir):
+                stats = update_library(business_logic, self.TYPE, source, remove_obsolete=True)
+            self.assertEqual(stats.counts["obsolete"], 1)
+            src_names.remove(obsolete_file)
+            self.assertEqual(sorted(src_name for src_name in business_logic.get_all_src_names()
+                                    if src_name.startswith(source)), sorted(src_names))
+            self.assertIn(sub_file, src_names)
+        finally:
+            shutil.rmtree(tmp_dir)
+            shutil.rmtree(source)
+
+    def test_watch(self):
+        """
+        follow the changes of a source directory
+        """
+        source = self.make_source(1)
+        tmp_dir = tempfile.mkdtemp()
+        db = os.path.join(tmp_dir, "copy.db")
+        self.copy_db(db)
+        business_logic = BusinessLogic(db)
+        watcher = LibraryWatcher(business_logic, self.TYPE, source)
+        file_name = os.path.basename(self.EXISTING_FILE)
+
+        def src_names():
+            """
+            return the files below source in the library
+            """
+            return sorted(src_name for src_name in business_logic.get_all_src_names()
+                          if src_name.startswith(os.path.join(source, "")))
+
+        def flush():
+            """
+            handle the events so far and write them
+            """
+            events = watcher.inotify.read_events()
+            while events:
+                for event in events:
+                    watcher.handle_event(*event)
+                events = watcher.inotify.read_events()
+            watcher.flush()
+
+        try:
+            watcher.watch_tree(watcher.source)
+            update_library(business_logic, self.TYPE, source)
+            before = src_names()
+            self.assertEqual(len(before), 1)
+            # a new directory with a file
+            sub_dir = os.path.join(source, "sub")
+            os.mkdir(sub_dir)
+            shutil.copyfile(self.EXISTING_FILE, os.path.join(sub_dir, file_name))
+            flush()
+            self.assertEqual(src_names(), sorted(before + [os.path.join(sub_dir, file_name)]))
+            # move the directory, files created in it afterwards are found as well
+            moved_dir = os.path.join(source, "moved")
+            os.rename(sub_dir, moved_dir)
+            shutil.copyfile(self.EXISTING_FILE, os.path.join(moved_dir, "new_" + file_name))
+            flush()
+            self.assertEqual(src_names(), sorted(before + [os.path.join(moved_dir, file_name),
+                                                           os.path.join(moved_dir,
+                                                                        "new_" + file_name)]))
+            # delete a file, then the directory
+            os.unlink(os.path.join(moved_dir, file_name))
+            flush()
+            self.assertEqual(src_names(), sorted(before + [os.path.join(moved_dir,
+                                                                        "new_" + file_name)]))
+            shutil.rmtree(moved_dir)
+            flush()
+            self.assertEqual(src_names(), before)
+            # after a queue overflow, the events are lost and everything is scanned again
+            lost_dir = os.path.join(source, "lost")
+            os.mkdir(lost_dir)
+            shutil.copyfile(self.EXISTING_FILE, os.path.join(lost_dir, file_name))
+            watcher.inotify.read_events()
+            watcher.rescan = True
+            watcher.flush()
+            self.assertEqual(src_names(), sorted(before + [os.path.join(lost_dir, file_name)]))
+            self.assertIn(lost_dir, watcher.dir2wd)
+        finally:
+            watcher.close()
+            shutil.rmtree(tmp_dir)
+            shutil.rmtree(source)
+
+    def test_resume(self):
+        """
+        resume an interrupted update, whose checkpoints say that
+        all files in a directory have been written already.
+        """
+        before = os.listdir(self.EXISTING_DIR)
+        source = self.make_source(1)
+        done_dir = os.path.join(source, "done")
+        os.mkdir(done_dir)
+        shutil.copyfile(self.EXISTING_FILE,
+                        os.path.join(done_dir, os.path.basename(self.EXISTING_FILE)))
+        connection = sqlite3.connect(self.LIBFS_DB)
+        try:
+            connection.execute("INSERT INTO checkpoints (source, directory) VALUES (?, ?)",
+                               (source, done_dir))
+            connection.commit()
+            self.run_update("--resume", source=source)
+            # only the file outside of the completed directory has been added
+            self.assertEqual(len(os.listdir(self.EXISTING_DIR)), len(before) + 1)
+            res = connection.execute("SELECT COUNT(*) FROM checkpoints WHERE source=?",
+                                     (source,)).fetchall()
+            self.assertEqual(res[0][0], 0)
+        finally:
+            connection.close()
+            self.remove_source(source)
+        self.assertEqual(sorted(os.listdir(self.EXISTING_DIR)), sorted(before))
+
+    def copy_db(self, path):
+        """
+        copy the library while it is mounted
+        """
+        source = sqlite3.connect(self.LIBFS_DB)
+        target = sqlite3.connect(path)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+
+    def test_trees_incremental(self):
+        """
+        the trees updated by every batch of new, moved and changed files
+        must be the same as if they were generated from scratch
+        """
+        source = self.make_source(4)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            db = os.path.join(tmp_dir, "copy.db")
+            self.copy_db(db)
+            business_logic = BusinessLogic(db)
+            src_names = sorted(os.listdir(source))
+            update_library(business_logic, self.TYPE, source)
+            # a moved file keeps its inode
+            os.rename(os.path.join(source, src_names[0]), os.path.join(source, "moved"))
+            # a hard link has the same inode as another file
+            os.link(os.path.join(source, src_names[1]), os.path.join(source, "linked"))
+            # a changed file is read again
+            stat_info = os.stat(os.path.join(source, src_names[2]))
+            os.utime(os.path.join(source, src_names[2]),
+                     ns=(stat_info.st_atime_ns, stat_info.st_mtime_ns + 10**9))
+            # written again with the same metadata, like by a rename through the mount
+            business_logic.add_entries(
+                [(os.path.join(source, src_names[3]),
+                  business_logic.get_entry(os.path.join(source, src_names[3])), None)])
+            update_library(business_logic, self.TYPE, source, remove_obsolete=True)
+            query_str = "SELECT * FROM trees ORDER BY view, vdir, gen_name, dup"
+            trees = business_logic.DB_BE.execute_query(query_str)
+            for view_name in business_logic.get_views():
+                business_logic.rebuild_view(view_name)
+            self.assertEqual(business_logic.DB_BE.execute_query(query_str), trees)
+            self.assertIn(os.path.join(source, "moved"), business_logic.get_all_src_names())
+        finally:
+            shutil.rmtree(tmp_dir)
+            shutil.rmtree(source)
+
+    def test_migrate(self):
+        """
+        convert a library with a column for every valid key and unique
+        inodes, like created by older versions, to the compact layout.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            compact_db = os.path.join(tmp_dir, "compact.db")
+            old_db = os.path.join(tmp_dir, "old.db")
+            self.copy_db(compact_db)
+            self.copy_db(old_db)
+            connection = sqlite3.connect(old_db)
+            valid_keys = json.loads(connection.execute("SELECT json FROM defaults").fetchone()[0])\
+                         ["valid_keys"]
+            columns = [tpl[1] for tpl in connection.execute("PRAGMA table_info(files)")]
+            exprs = [k if k in columns else
+                     "coalesce(json_extract(extra, '$.\"%s\"'), 'Unknown')" % k
+                     for k in valid_keys]
+            connection.execute("CREATE TABLE old_files (src_filename varchar unique, "\
+                               "src_inode integer unique, src_size integer, "\
+                               "src_mtime_ns integer, %s)" % ",".join(valid_keys))
+            connection.execute("INSERT INTO old_files SELECT src_filename, src_inode, src_size, "\
+                               "src_mtime_ns, %s FROM files ORDER BY rowid" % ",".join(exprs))
+            connection.execute("DROP TABLE files")
+            connection.execute("DROP TABLE trees")
+            connection.execute("ALTER TABLE old_files RENAME TO files")
+            connection.commit()
+            connection.close()
+
+            output = subprocess.check_output([self.LIBFS_BIN, "--logconf", self.LIBFS_LOG_CFG,
+                                              "migrate", old_db]).decode()
+            self.assertIn("Converted", output)
+            expected = BusinessLogic(compact_db)
+            migrated = BusinessLogic(old_db)
+            self.assertTrue(migrated.compact)
+            self.assertFalse(migrated.unique_inodes)
+            src_names = expected.get_all_src_names()
+            self.assertEqual(sorted(migrated.get_all_src_names()), sorted(src_names))
+            for src_name in src_names:
+                self.assertEqual(migrated.get_entry(src_name), expected.get_entry(src_name))
+            vpath = self.EXISTING_DIR[len(self.LIBFS_MNT):]
+            self.assertEqual(migrated.get_contents_by_vpath(vpath),
+                             expected.get_contents_by_vpath(vpath))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_parse_fn_gen(self):
+        """
+        parse filename generators with escaped and special characters
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            db = os.path.join(tmp_dir, "copy.db")
+            self.copy_db(db)
+            business_logic = BusinessLogic(db)
+            key = business_logic.current_view["dirtree"][0]
+            # "%%" is a literal "%", so "%%{key}" is not replaced
+            fn_gen_keys, reg_ex, template, template_keys = \
+                business_logic.parse_fn_gen("%%{" + key + "} 100%% {%{" + key + "}}.(1)")
+            self.assertEqual(fn_gen_keys, [key])
+            self.assertEqual(template_keys, [business_logic.SRC_FILENAME_KEY, key])
+            gen_name = business_logic.generate_filename(template, "/src/a.jpg", ["A+"])
+            self.assertEqual(gen_name, "%{" + key + "} 100% {A+}.(1)")
+            self.assertEqual(re.match(reg_ex, gen_name).groups(), ("A+",))
+            # the other characters only match themselves
+            self.assertIsNone(re.match(reg_ex, "%{" + key + "} 100% {A+}x(1)"))
+            self.assertIsNone(re.match(reg_ex, "%{" + key + "} 1000% {A+}.(1)"))
+            # unknown keys are left as they are
+            fn_gen_keys, reg_ex, template, template_keys = \
+                business_logic.parse_fn_gen("%{no_such_key}-%{src_filename}")
+            self.assertEqual(fn_gen_keys, ["no_such_key", business_logic.SRC_FILENAME_KEY])
+            self.assertEqual(template_keys, [business_logic.SRC_FILENAME_KEY])
+            gen_name = business_logic.generate_filename(template, "/src/a.jpg", [])
+            self.assertEqual(gen_name, "%{no_such_key}-a.jpg")
+            self.assertEqual(re.match(reg_ex, gen_name).groups(), ("%{no_such_key}", "a.jpg"))
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -2,6 +2,14 @@
 """
 Actual test of EXIF
 """
+import errno
+import os
+import tempfile
+import unittest
+
+import piexif
+
+from Libfs.plugins.exif import load_exif, read_exif_segment
 from test.test_base import TestBase
 
 class EXIFTest(TestBase):
@@ -16,3 +24,111 @@ class EXIFTest(TestBase):
     NON_EXISTING_FILE = "%s/Jolla/Jolla/2017/4/21/11:52:2.jpeg" % TestBase.LIBFS_MNT
     NON_EXISTING_DIR = "%s/Jolla/Jolla/2017/4/22/" % TestBase.LIBFS_MNT
 
+class EXIFWorkersTest(EXIFTest):
+    """
+    the same tests with several threads serving the mount,
+    so that the renames are not done by the thread which opened the db
+    """
+    MOUNT_OPTIONS = ["--workers", "2"]
+
+class EXIFSnapshotTest(EXIFTest):
+    """
+    the same library mounted read-only from memory.
+    Changes through the mount fail, updates are not seen by the listings.
+    """
+    MOUNT_OPTIONS = ["--snapshot"]
+
+    def assert_read_only(self, func, *args):
+        """
+        func must fail because the mount is read-only
+        """
+        with self.assertRaises(OSError) as excep:
+            func(*args)
+        self.assertEqual(excep.exception.errno, errno.EROFS)
+
+    def test_listing(self):
+        """
+        list a directory and read a file in it
+        """
+        self.assertIn(os.path.basename(self.EXISTING_FILE), os.listdir(self.EXISTING_DIR))
+        with open(self.EXISTING_FILE, "rb") as src_file:
+            self.assertGreater(len(src_file.read()), 0)
+
+    def test_file_mv(self):
+        """
+        rename a file
+        """
+        self.assert_read_only(os.rename, self.EXISTING_FILE, self.NON_EXISTING_FILE)
+        self.assertTrue(os.path.exists(self.EXISTING_FILE))
+
+    def test_file_mv_entry(self):
+        """
+        nothing to check, files cannot be renamed
+        """
+        self.test_file_mv()
+
+    def test_dir_mv(self):
+        """
+        rename a dir
+        """
+        self.assert_read_only(os.rename, self.EXISTING_DIR, self.NON_EXISTING_DIR)
+        self.assertTrue(os.path.isdir(self.EXISTING_DIR))
+
+    def test_dir_mv_listing(self):
+        """
+        nothing to check, dirs cannot be renamed
+        """
+        self.test_dir_mv()
+
+    def test_mkdir_rmdir(self):
+        """
+        create a dir
+        """
+        self.assert_read_only(os.mkdir, self.NON_EXISTING_DIR)
+
+    @unittest.skip("the listings of a snapshot do not change")
+    def test_readdir_chunks(self):
+        """
+        new files are not listed
+        """
+
+    @unittest.skip("the listings of a snapshot do not change")
+    def test_remove_obsolete(self):
+        """
+        new and removed files are not listed
+        """
+
+    @unittest.skip("the listings of a snapshot do not change")
+    def test_resume(self):
+        """
+        new files are not listed
+        """
+
+class EXIFLoadTest(unittest.TestCase):
+    """
+    reading only the EXIF block of a file must give the same result as piexif
+    """
+    JPEG_FILE = "./test/data/exif/20170421_105202.jpg"
+
+    def test_load_jpeg(self):
+        """
+        only the header of a JPEG is parsed
+        """
+        self.assertIsNotNone(read_exif_segment(self.JPEG_FILE))
+        self.assertEqual(load_exif(self.JPEG_FILE), piexif.load(self.JPEG_FILE))
+
+    def test_load_tiff(self):
+        """
+        other files are passed on to piexif as they are
+        """
+        exif_dict = piexif.load(self.JPEG_FILE)
+        exif_dict.pop("thumbnail", None)
+        # the TIFF-structure following the "Exif" header of the APP1 segment
+        fd, tiff_file = tempfile.mkstemp(suffix=".tif")
+        try:
+            os.write(fd, piexif.dump(exif_dict)[6:])
+            os.close(fd)
+            self.assertIsNone(read_exif_segment(tiff_file))
+            self.assertEqual(load_exif(tiff_file), piexif.load(tiff_file))
+        finally:
+            os.unlink(tiff_file)